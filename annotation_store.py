@@ -0,0 +1,217 @@
+#This module implements a compact, memory-mappable binary store for the COCO annotations.
+#Every column is a raw little-endian array in its own file: bbox, area and category columns for
+#the annotations, a flat coordinate buffer with per-polygon offsets for the segmentations, and
+#per-image offsets into the annotation rows. Looking up the annotations of one image is O(1)
+#and only touches the rows it needs, instead of parsing the whole JSON file first.
+
+import json
+import os
+import shutil
+import numpy as np
+
+#Column name -> (dtype, values per row).
+COLUMNS = {
+    'image_id': ('<i8', 1),
+    'image_width': ('<i4', 1),
+    'image_height': ('<i4', 1),
+    'image_ann_start': ('<i8', 1),
+    'ann_id': ('<i8', 1),
+    'ann_image_id': ('<i8', 1),
+    'category_id': ('<i4', 1),
+    'area': ('<f8', 1),
+    'bbox': ('<f8', 4),
+    'iscrowd': ('u1', 1),
+    'ann_poly_start': ('<i8', 1),
+    'poly_coord_start': ('<i8', 1),
+    'coords': ('<f8', 1),
+}
+
+class AnnotationStoreWriter:
+    #Streams images and their annotations into a store directory. The store is built in a
+    #temporary directory and moved into place when the writer is closed.
+    def __init__(self, path, categories):
+        self.path = path
+        self.categories = categories
+        self.num_images = 0
+        self.num_annotations = 0
+        self.num_polygons = 0
+        self.num_coords = 0
+        self._contiguous = True
+        self._first_id = None
+        self._tmp_path = path + '.tmp'
+        if os.path.exists(self._tmp_path):
+            shutil.rmtree(self._tmp_path)
+        os.makedirs(self._tmp_path)
+        self._files = {name: open(os.path.join(self._tmp_path, f'{name}.bin'), 'wb') for name in COLUMNS}
+        self._names = open(os.path.join(self._tmp_path, 'file_names.txt'), 'w', encoding='utf-8')
+
+        #Offset columns start with a leading zero, so row i spans [start[i], start[i + 1]).
+        for name in ('image_ann_start', 'ann_poly_start', 'poly_coord_start'):
+            self._write(name, [0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _write(self, name, values):
+        dtype, _ = COLUMNS[name]
+        self._files[name].write(np.asarray(values, dtype=dtype).tobytes())
+
+    def add_patch(self, image, annotations):
+        #Add one COCO image entry and its annotations, as returned by CocoJsonWriter.add_patch.
+        if self._first_id is None:
+            self._first_id = image['id']
+        if image['id'] != self._first_id + self.num_images:
+            self._contiguous = False
+        self._write('image_id', [image['id']])
+        self._write('image_width', [image['width']])
+        self._write('image_height', [image['height']])
+        self._names.write(image['file_name'] + '\n')
+        self.num_images += 1
+
+        poly_ends, coords = [], []
+        ann_poly_ends = []
+        for ann in annotations:
+            if not isinstance(ann['segmentation'], list):
+                raise ValueError("The annotation store only supports polygon segmentations")
+            for poly in ann['segmentation']:
+                coords.append(np.asarray(poly, dtype=np.float64))
+                self.num_coords += len(poly)
+                poly_ends.append(self.num_coords)
+            self.num_polygons += len(ann['segmentation'])
+            ann_poly_ends.append(self.num_polygons)
+
+        self._write('ann_id', [ann['id'] for ann in annotations])
+        self._write('ann_image_id', [ann['image_id'] for ann in annotations])
+        self._write('category_id', [ann['category_id'] for ann in annotations])
+        self._write('area', [ann['area'] for ann in annotations])
+        self._write('bbox', [ann['bbox'] for ann in annotations])
+        self._write('iscrowd', [ann['iscrowd'] for ann in annotations])
+        self._write('ann_poly_start', ann_poly_ends)
+        self._write('poly_coord_start', poly_ends)
+        if coords:
+            self._write('coords', np.concatenate(coords))
+        self.num_annotations += len(annotations)
+        self._write('image_ann_start', [self.num_annotations])
+
+    def close(self):
+        #Write the metadata and move the finished store into place.
+        for f in self._files.values():
+            f.close()
+        self._names.close()
+        meta = {
+            'counts': {
+                'images': self.num_images,
+                'annotations': self.num_annotations,
+                'polygons': self.num_polygons,
+                'coords': self.num_coords,
+            },
+            'columns': {name: list(spec) for name, spec in COLUMNS.items()},
+            'contiguous_ids': self._contiguous,
+            'categories': self.categories,
+        }
+        with open(os.path.join(self._tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=4)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        #Discard a partially written store.
+        for f in self._files.values():
+            f.close()
+        self._names.close()
+        shutil.rmtree(self._tmp_path, ignore_errors=True)
+
+class AnnotationStore:
+    #Read-only, memory-mapped access to a store written by AnnotationStoreWriter.
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.path = path
+        self.categories = meta['categories']
+        self._cols = {}
+        for name, (dtype, width) in meta['columns'].items():
+            file_path = os.path.join(path, f'{name}.bin')
+            rows = os.path.getsize(file_path) // (np.dtype(dtype).itemsize * width)
+            shape = (rows, width) if width > 1 else (rows,)
+            if rows == 0:
+                #Empty files cannot be memory-mapped.
+                self._cols[name] = np.zeros(shape, dtype=dtype)
+            else:
+                self._cols[name] = np.memmap(file_path, dtype=dtype, mode='r', shape=shape)
+        with open(os.path.join(path, 'file_names.txt'), 'r', encoding='utf-8') as f:
+            self._file_names = f.read().splitlines()
+
+        #Map image ids to rows; ids written by preprocess.py are contiguous, so no table is needed.
+        ids = self._cols['image_id']
+        self._first_id = int(ids[0]) if len(ids) else 0
+        self._rows = None if meta['contiguous_ids'] else {int(i): row for row, i in enumerate(ids)}
+
+    def __len__(self):
+        return len(self._file_names)
+
+    def image_ids(self):
+        return self._cols['image_id'].tolist()
+
+    def _row(self, image_id):
+        if self._rows is not None:
+            return self._rows[image_id]
+        row = image_id - self._first_id
+        if not 0 <= row < len(self):
+            raise KeyError(image_id)
+        return row
+
+    def image(self, image_id):
+        #Return the COCO image entry of an image.
+        row = self._row(image_id)
+        return {
+            'id': int(self._cols['image_id'][row]),
+            'width': int(self._cols['image_width'][row]),
+            'height': int(self._cols['image_height'][row]),
+            'file_name': self._file_names[row],
+        }
+
+    def _polygons(self, ann_row):
+        #Return the polygons of one annotation as flat coordinate arrays.
+        poly_start = self._cols['ann_poly_start']
+        coord_start = self._cols['poly_coord_start']
+        coords = self._cols['coords']
+        return [coords[coord_start[p]:coord_start[p + 1]]
+                for p in range(poly_start[ann_row], poly_start[ann_row + 1])]
+
+    def annotations(self, image_id):
+        #Return the COCO annotations of an image.
+        row = self._row(image_id)
+        start, end = self._cols['image_ann_start'][row:row + 2]
+        cols = self._cols
+        return [{
+            'id': int(cols['ann_id'][a]),
+            'image_id': int(cols['ann_image_id'][a]),
+            'category_id': int(cols['category_id'][a]),
+            'segmentation': [poly.tolist() for poly in self._polygons(a)],
+            'area': float(cols['area'][a]),
+            'bbox': cols['bbox'][a].tolist(),
+            'iscrowd': int(cols['iscrowd'][a]),
+        } for a in range(start, end)]
+
+    def first_polygons(self, image_id):
+        #Return (category_id, coordinates) of the first polygon of every annotation of an image,
+        #with the coordinates as a flat NumPy array, which is what the YOLO conversion needs.
+        row = self._row(image_id)
+        start, end = self._cols['image_ann_start'][row:row + 2]
+        poly_start = self._cols['ann_poly_start']
+        coord_start = self._cols['poly_coord_start']
+        coords = self._cols['coords']
+        result = []
+        for a in range(start, end):
+            if poly_start[a] == poly_start[a + 1]:
+                continue
+            p = poly_start[a]
+            result.append((int(self._cols['category_id'][a]), coords[coord_start[p]:coord_start[p + 1]]))
+        return result
@@ -0,0 +1,299 @@
+#This program benchmarks each stage of the pipeline on synthetic iSAID-like scenes.
+#It generates scenes with the iSAID directory layout and RGB instance encoding, then times
+#split.main, preprocess.main, generate_test_json.main and convert_isaid_to_yolo_seg separately.
+#Every stage runs in its own process, so its peak memory is measured on its own. The results
+#(images/sec, annotations/sec, peak RSS and bytes written) are written as JSON.
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+
+#The iSAID encoding id = r // 10 * 256 + g can represent ids up to 25 * 256 + 255 = 6655,
+#so with class = id // 1000 only classes 1 to 6 are available to synthetic instances.
+MAX_CLASS = 6
+MAX_INSTANCE_ID = 25 * 256 + 255
+
+#Marks a directory created by the benchmark, so it is never wiped unless the benchmark made it.
+BENCH_MARKER = '.isaid_bench'
+
+def parse_args():
+    #Parse command line arguments for the benchmark parameters.
+    parser = argparse.ArgumentParser(description='Benchmark the iSAID pipeline on synthetic scenes')
+    parser.add_argument('--workdir', default=None, type=str,
+                        help="Directory in which the synthetic dataset and outputs are written to an "
+                             "isaid_bench subdirectory (default: a temporary directory).")
+    parser.add_argument('--keep', action='store_true',
+                        help="Keep the work directory after the benchmark.")
+    parser.add_argument('--scenes', default=2, type=int,
+                        help="Number of synthetic scenes per split.")
+    parser.add_argument('--height', default=2000, type=int)
+    parser.add_argument('--width', default=2000, type=int)
+    parser.add_argument('--density', default=50.0, type=float,
+                        help="Instances per megapixel.")
+    parser.add_argument('--patch_size', default=800, type=int)
+    parser.add_argument('--overlap_area', default=200, type=int)
+    parser.add_argument('--workers', default=1, type=int,
+                        help="Number of worker processes passed to every stage.")
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--output', default=None, type=str,
+                        help="Write the JSON report to this file instead of stdout.")
+    return parser.parse_args()
+
+def instance_color(instance_id):
+    #Encode an instance id as a BGR pixel of an _instance_id_RGB map (r = id // 256 * 10, g = id % 256).
+    return (0, instance_id % 256, instance_id // 256 * 10)
+
+def make_scene(rng, h, w, density):
+    #Return (image, instance id map, instance color map, number of instances) of one synthetic scene.
+    #Instances are filled rectangles and ellipses of random class, size and orientation.
+    yy, xx = np.mgrid[0:h, 0:w]
+    image = np.stack([(xx * 255 // max(w - 1, 1)), (yy * 255 // max(h - 1, 1)),
+                      np.full((h, w), 96)], axis=2).astype(np.uint8)
+    image = cv2.add(image, rng.integers(0, 24, (h, w, 3), dtype=np.uint8))
+    id_map = np.zeros((h, w, 3), np.uint8)
+    color_map = np.zeros((h, w, 3), np.uint8)
+
+    num_instances = int(round(density * h * w / 1e6))
+    used = set()
+    for _ in range(num_instances):
+        class_id = int(rng.integers(1, MAX_CLASS + 1))
+        instance_id = class_id * 1000 + int(rng.integers(1, 1000))
+        if instance_id > MAX_INSTANCE_ID or instance_id in used:
+            continue
+        used.add(instance_id)
+        cy, cx = int(rng.integers(0, h)), int(rng.integers(0, w))
+        ry, rx = int(rng.integers(4, 60)), int(rng.integers(4, 60))
+        angle = float(rng.uniform(0, 180))
+        class_color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        for target, color in ((id_map, instance_color(instance_id)), (color_map, class_color),
+                              (image, class_color)):
+            if class_id % 2:
+                cv2.ellipse(target, (cx, cy), (rx, ry), angle, 0, 360, color, -1)
+            else:
+                box = cv2.boxPoints(((cx, cy), (2 * rx, 2 * ry), angle)).astype(np.int32)
+                cv2.fillPoly(target, [box], color)
+    return image, id_map, color_map, len(used)
+
+def generate_dataset(src_root, args):
+    #Write the synthetic scenes in the iSAID layout: <split>/images/P0000.png, with instance
+    #masks for train and val. Returns the number of instances per split.
+    rng = np.random.default_rng(args.seed)
+    instances = {}
+    for split in ('train', 'val', 'test'):
+        image_dir = os.path.join(src_root, split, 'images')
+        os.makedirs(image_dir, exist_ok=True)
+        instances[split] = 0
+        for i in range(args.scenes):
+            image, id_map, color_map, n = make_scene(rng, args.height, args.width, args.density)
+            base = f"P{i:04d}"
+            cv2.imwrite(os.path.join(image_dir, f"{base}.png"), image)
+            if split != 'test':
+                cv2.imwrite(os.path.join(image_dir, f"{base}_instance_id_RGB.png"), id_map)
+                cv2.imwrite(os.path.join(image_dir, f"{base}_instance_color_RGB.png"), color_map)
+                instances[split] += n
+    return instances
+
+def tree_size(path):
+    #Return the total size in bytes of all files below path.
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+def peak_rss():
+    #Return the peak resident set size in bytes of this process and of its waited-for
+    #children (pool workers), or None where it cannot be measured (e.g. on Windows).
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    #ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    rss_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    #On Linux ru_maxrss survives exec, so a spawned process reports its parent's peak if that
+    #was higher. VmHWM is the high-water mark of this process's own memory.
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    rss_self = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return rss_self, rss_children
+
+def run_stage(stage, config, conn):
+    #Run one pipeline stage in this (child) process and send back its duration and peak memory.
+    #The stages' progress output is discarded so it does not distort the timing.
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import split
+    import preprocess
+    import generate_test_json
+    from convert_to_yolo import convert_isaid_to_yolo_seg
+    ns = argparse.Namespace
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        if stage == 'split':
+            split.main(ns(src=config['src'], tar=config['patches'], set='train,val,test',
+                          image_sub_folder='images', patch_height=config['patch_size'],
+                          patch_width=config['patch_size'], overlap_area=config['overlap_area'],
+                          workers=config['workers']))
+        elif stage == 'preprocess':
+            preprocess.main(ns(datadir=config['patches'], outdir=config['patches'], set='train,val',
+                               workers=config['workers']))
+        elif stage == 'generate_test_json':
+            generate_test_json.main(ns(datadir=config['patches'], outdir=config['patches'], set='test'))
+        elif stage == 'convert_to_yolo':
+            convert_isaid_to_yolo_seg(config['patches'], config['yolo'], workers=config['workers'])
+        seconds = time.perf_counter() - start
+    rss_main, rss_workers = peak_rss()
+    conn.send({'seconds': seconds, 'peak_rss_bytes': rss_main, 'peak_rss_workers_bytes': rss_workers})
+    conn.close()
+
+def count_annotations(patch_root, splits):
+    #Return (images, annotations) in the COCO JSON files of the given splits.
+    images = annotations = 0
+    for split in splits:
+        path = os.path.join(patch_root, split, f'instancesonly_filtered_{split}.json')
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            images += len(data['images'])
+            annotations += len(data['annotations'])
+    return images, annotations
+
+def count_patches(patch_root):
+    #Return the number of RGB patches written by split.py.
+    count = 0
+    for split in ('train', 'val', 'test'):
+        image_dir = os.path.join(patch_root, split, 'images')
+        if os.path.isdir(image_dir):
+            count += sum(1 for f in os.listdir(image_dir) if '_instance_' not in f)
+    return count
+
+def benchmark_stage(stage, config):
+    #Run a stage in a fresh process and return its measurements, including the bytes it wrote.
+    before = tree_size(config['workdir'])
+    ctx = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=run_stage, args=(stage, config, child_conn))
+    proc.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = None
+    proc.join()
+    if result is None or proc.exitcode != 0:
+        raise RuntimeError(f"Stage {stage} failed with exit code {proc.exitcode}")
+    result['bytes_written'] = tree_size(config['workdir']) - before
+    return result
+
+def add_rates(result, images, annotations):
+    #Add image and annotation counts and throughput to a stage result.
+    result['images'] = images
+    result['images_per_sec'] = images / result['seconds'] if result['seconds'] > 0 else None
+    if annotations is not None:
+        result['annotations'] = annotations
+        result['annotations_per_sec'] = annotations / result['seconds'] if result['seconds'] > 0 else None
+    return result
+
+def prepare_bench_dir(workdir):
+    #Return the benchmark's own directory, <workdir>/isaid_bench, emptied from a previous run.
+    #A directory of that name that the benchmark did not create is refused rather than removed.
+    bench_dir = os.path.join(workdir, 'isaid_bench')
+    if os.path.exists(bench_dir):
+        if not os.path.exists(os.path.join(bench_dir, BENCH_MARKER)):
+            raise SystemExit(f"{bench_dir} exists and was not created by benchmark.py; "
+                             "choose another --workdir")
+        shutil.rmtree(bench_dir)
+    os.makedirs(bench_dir)
+    open(os.path.join(bench_dir, BENCH_MARKER), 'w').close()
+    return bench_dir
+
+def main(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='isaid_bench_')
+    bench_dir = prepare_bench_dir(workdir)
+    config = {
+        'workdir': bench_dir,
+        'src': os.path.join(bench_dir, 'iSAID_dataset'),
+        'patches': os.path.join(bench_dir, 'iSAID_patches'),
+        'yolo': os.path.join(bench_dir, 'iSAID_YOLO_Dataset'),
+        'patch_size': args.patch_size,
+        'overlap_area': args.overlap_area,
+        'workers': args.workers,
+    }
+
+    try:
+        print(f"Generating {args.scenes} synthetic scenes per split in {bench_dir}...", file=sys.stderr)
+        start = time.perf_counter()
+        instances = generate_dataset(config['src'], args)
+        generate_seconds = time.perf_counter() - start
+
+        stages = {}
+        print("Benchmarking split...", file=sys.stderr)
+        stages['split'] = add_rates(benchmark_stage('split', config), 3 * args.scenes, None)
+        stages['split']['patches'] = count_patches(config['patches'])
+
+        print("Benchmarking preprocess...", file=sys.stderr)
+        result = benchmark_stage('preprocess', config)
+        stages['preprocess'] = add_rates(result, *count_annotations(config['patches'], ('train', 'val')))
+
+        print("Benchmarking generate_test_json...", file=sys.stderr)
+        result = benchmark_stage('generate_test_json', config)
+        stages['generate_test_json'] = add_rates(result, count_annotations(config['patches'], ('test',))[0], None)
+
+        print("Benchmarking convert_to_yolo...", file=sys.stderr)
+        result = benchmark_stage('convert_to_yolo', config)
+        stages['convert_to_yolo'] = add_rates(result, *count_annotations(config['patches'], ('train', 'val', 'test')))
+
+        report = {
+            'config': {
+                'scenes_per_split': args.scenes,
+                'height': args.height,
+                'width': args.width,
+                'density_per_mpx': args.density,
+                'patch_size': args.patch_size,
+                'overlap_area': args.overlap_area,
+                'workers': args.workers,
+                'seed': args.seed,
+            },
+            'dataset': {
+                'instances': instances,
+                'bytes': tree_size(config['src']),
+                'generate_seconds': generate_seconds,
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'numpy': np.__version__,
+                'opencv': cv2.__version__,
+                'cpu_count': os.cpu_count(),
+            },
+            'stages': stages,
+        }
+    finally:
+        if not args.keep and args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+        print(f"Wrote benchmark report to {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
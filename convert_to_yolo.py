@@ -7,6 +7,19 @@ import json
 import shutil
 from pathlib import Path
 import argparse
+from multiprocessing import Pool
+import numpy as np
+from manifest import Manifest, describe_files, data_digest
+from shards import ShardWriter
+from annotation_store import AnnotationStore
+import profiler
+
+LINK_MODES = ('copy', 'hardlink', 'symlink', 'reflink')
+
+#ioctl request number of FICLONE on Linux (Btrfs, XFS and other copy-on-write filesystems).
+FICLONE = 0x40049409
+
+_reported_fallbacks = set()
 
 def parse_args():
     #Parse command line arguments for input and output directories.
@@ -15,98 +28,315 @@ def parse_args():
                         help="Path to the root directory of the preprocessed iSAID dataset (input).")
     parser.add_argument('--outdir', type=str, default='./iSAID_YOLO_Dataset',
                         help="Path to the root directory where the YOLO formatted dataset will be saved (output).")
-    return parser.parse_args()
+    parser.add_argument('--link_mode', type=str, default='copy', choices=LINK_MODES,
+                        help="How images are placed in the output: copied, hard-linked, symlinked or "
+                             "reflinked (copy-on-write clone). Falls back to a copy if linking fails.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes used to write the label files.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Skip images whose source image, annotations and options are unchanged since the last run.")
+    parser.add_argument('--output_format', type=str, default='files', choices=['files', 'tar'],
+                        help="Write the YOLO images/labels directories, or pack every image with its label "
+                             "file into tar shards (shards/<split>/) with an offset index.")
+    parser.add_argument('--shard_size', type=int, default=1024,
+                        help="Target size of each tar shard in MB.")
+    parser.add_argument('--annotation_store', action='store_true',
+                        help="Read the annotations from the memory-mapped binary store written by "
+                             "preprocess.py --binary_store instead of parsing the COCO JSON files.")
+    parser.add_argument('--profile', nargs='?', const='profile_convert_to_yolo.json', default=None,
+                        help="Record time and call counts of the hot sections, per-image time and peak "
+                             "memory, and write a JSON report (default: profile_convert_to_yolo.json).")
+    args = parser.parse_args()
+    if args.incremental and args.output_format == 'tar':
+        parser.error("--incremental is only supported with --output_format files")
+    return args
+
+def _reflink(src, dst):
+    #Clone the file contents without copying data blocks (Linux only).
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copymode(src, dst)
+
+def place_image(src, dst, link_mode='copy'):
+    #Place src at dst with the requested link mode, falling back to a plain copy
+    #when the filesystem does not support it (e.g. a hard link across devices).
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if link_mode != 'copy':
+        try:
+            if link_mode == 'hardlink':
+                os.link(src, dst)
+            elif link_mode == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+            elif link_mode == 'reflink':
+                _reflink(src, dst)
+            return
+        except (OSError, ImportError, NotImplementedError) as e:
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if link_mode not in _reported_fallbacks:
+                _reported_fallbacks.add(link_mode)
+                print(f"Warning: {link_mode} failed ({e}); falling back to copying.")
+    shutil.copy(src, dst)
+
+def format_yolo_labels(polygons, w, h):
+    #Convert (class index, polygon) pairs of one image to YOLO segmentation label text.
+    #All coordinates of the image are normalised in one NumPy operation and formatted
+    #with a single %-format call, giving the same text as per-value f"{v:.6f}" formatting.
+    if not polygons:
+        return ""
+    coords = np.concatenate([np.asarray(seg, dtype=np.float64) for _, seg in polygons])
+    coords = (coords.reshape(-1, 2) / np.array([w, h], dtype=np.float64)).ravel()
+    fmt = "".join(f"{cls_idx}" + " %.6f" * len(seg) + "\n" for cls_idx, seg in polygons)
+    return fmt % tuple(coords.tolist())
+
+def write_yolo_label(task):
+    #Write the label file of one image; task is (label_path, polygons, width, height).
+    label_path, polygons, w, h = task
+    with profiler.section('format_labels'):
+        text = format_yolo_labels(polygons, w, h)
+    with profiler.section('write_label'), open(label_path, "w") as f:
+        f.write(text)
+    return label_path
+
+def open_manifest(output_root, split, params, incremental):
+    #Return the incremental-rebuild manifest of a split, or None if incremental mode is off.
+    if not incremental:
+        return None
+    return Manifest(str(Path(output_root) / ".isaid_cache" / f"yolo_{split}.jsonl"), params)
+
+def open_shard_writer(output_root, split, output_format, shard_size):
+    #Return the tar shard writer of a split, or None when writing plain files.
+    if output_format != 'tar':
+        return None
+    return ShardWriter(str(Path(output_root) / "shards" / split), split, shard_size << 20)
 
-def convert_isaid_to_yolo_seg(input_root: str, output_root: str):
+def pack_yolo_sample(shard_writer, src_img_path, label_text):
+    #Pack one image and its label text as adjacent members of the current shard.
+    if not src_img_path.exists():
+        print(f"Warning: Source image not found: {src_img_path}")
+        return
+    with profiler.section('pack'):
+        with open(src_img_path, 'rb') as f:
+            data = f.read()
+        shard_writer.add_sample([(src_img_path.name, data),
+                                 (f"{src_img_path.stem}.txt", label_text.encode('utf-8'))])
+
+def rle_to_polygon(rle):
+    #Trace the outer contour of an RLE segmentation (preprocess.py --seg_format rle), since
+    #YOLO labels need polygons. Returns a flat [x1, y1, x2, y2, ...] list.
+    from pycocotools import mask as maskUtils
+    from skimage import measure
+    mask = maskUtils.decode(rle)
+    #Pad the mask so contours touching the border are closed, then undo the padding.
+    contours = measure.find_contours(np.pad(mask, 1), 0.5)
+    if not contours:
+        return []
+    contour = max(contours, key=len)
+    return (np.flip(contour, axis=1) - 1).ravel().tolist()
+
+def load_split_annotations(input_root, split, annotation_store=False):
+    #Return (images, categories, first_polygons) of a split, or None if it has no annotations.
+    #images maps image ids to COCO image entries and first_polygons(img_id) lists the
+    #(category id, first polygon) pairs of the image's annotations. With annotation_store the
+    #binary store written by preprocess.py --binary_store is memory-mapped instead of parsing the JSON.
+    json_path = Path(input_root) / split / f"instancesonly_filtered_{split}.json"
+    if annotation_store:
+        store_path = json_path.with_suffix(".store")
+        if not store_path.exists():
+            print(f"Warning: Annotation store not found for '{split}' split. Skipping: {store_path}")
+            return None
+        print(f"Processing '{split}' split...")
+        with profiler.section('store_open'):
+            store = AnnotationStore(str(store_path))
+            images = {img_id: store.image(img_id) for img_id in store.image_ids()}
+        return images, store.categories, store.first_polygons
+
+    if not json_path.exists():
+        print(f"Warning: JSON file not found for '{split}' split. Skipping: {json_path}")
+        return None
+
+    print(f"Processing '{split}' split...")
+    #Load COCO-format annotation file.
+    with profiler.section('json_load'), open(json_path, 'r') as f:
+        data = json.load(f)
+
+    #Create lookup dictionaries for images and annotations.
+    images = {img["id"]: img for img in data["images"]}
+
+    annos = {}
+    for ann in data["annotations"]:
+        seg = ann.get("segmentation")
+        if isinstance(seg, dict):
+            seg = [rle_to_polygon(seg)]
+        if seg and len(seg) > 0:
+            annos.setdefault(ann["image_id"], []).append((ann["category_id"], seg[0]))
+    return images, data["categories"], lambda img_id: annos.get(img_id, [])
+
+def convert_isaid_to_yolo_seg(input_root: str, output_root: str, link_mode: str = 'copy', workers: int = 1,
+                              incremental: bool = False, output_format: str = 'files', shard_size: int = 1024,
+                              annotation_store: bool = False, profile: str = None):
+    if profile:
+        profiler.enable()
     print(f"Starting conversion from '{input_root}' to YOLO format at '{output_root}'...")
     
     #Create YOLO directory structure for images and labels.
     for split in ("train", "val", "test"):
-        (Path(output_root) / "images" / split).mkdir(parents=True, exist_ok=True)
-        (Path(output_root) / "labels" / split).mkdir(parents=True, exist_ok=True)
+        if output_format == 'files':
+            (Path(output_root) / "images" / split).mkdir(parents=True, exist_ok=True)
+            (Path(output_root) / "labels" / split).mkdir(parents=True, exist_ok=True)
+    Path(output_root).mkdir(parents=True, exist_ok=True)
 
     #Process train and validation splits with annotations.
     for split in ("train", "val"):
-        json_path = Path(input_root) / split / f"instancesonly_filtered_{split}.json"
-        if not json_path.exists():
-            print(f"Warning: JSON file not found for '{split}' split. Skipping: {json_path}")
+        loaded = load_split_annotations(input_root, split, annotation_store)
+        if loaded is None:
             continue
-        
-        print(f"Processing '{split}' split...")
-        #Load COCO-format annotation file.
-        with open(json_path, 'r') as f:
-            data = json.load(f)
-        
-        #Create lookup dictionaries for images and annotations.
-        images = {img["id"]: img for img in data["images"]}
-        
-        annos = {}
-        for ann in data["annotations"]:
-            annos.setdefault(ann["image_id"], []).append(ann)
-            
+        images, categories, first_polygons = loaded
+
         #Create category ID to index mapping for YOLO format.
-        cat_ids = sorted(c["id"] for c in data["categories"])
+        cat_ids = sorted(c["id"] for c in categories)
         catid2idx = {cid: idx for idx, cid in enumerate(cat_ids)}
 
-        #Process each image and its annotations.
-        for img_id, img_info in images.items():
+        manifest = open_manifest(output_root, split, {"link_mode": link_mode, "categories": cat_ids}, incremental)
+        shard_writer = open_shard_writer(output_root, split, output_format, shard_size)
+        pending = {}
+        skipped = 0
+
+        #Place each image and collect its polygons for the label writers.
+        label_tasks = []
+        profiler.start_progress()
+        for i, (img_id, img_info) in enumerate(images.items(), 1):
+            profiler.progress(i, len(images))
             fname = img_info["file_name"]
-            w, h = img_info["width"], img_info["height"]
-            
-            #Copy image file to YOLO structure.
-            src_img_path = Path(input_root) / split / "images" / fname
-            dst_img_path = Path(output_root) / "images" / split / fname
-            if src_img_path.exists():
-                shutil.copy(src_img_path, dst_img_path)
+            with profiler.image(fname):
+                w, h = img_info["width"], img_info["height"]
+                src_img_path = Path(input_root) / split / "images" / fname
+                dst_img_path = Path(output_root) / "images" / split / fname
+                label_path = Path(output_root) / "labels" / split / f"{Path(fname).stem}.txt"
+
+                #Keep the first polygon of every annotation that forms a valid YOLO polygon.
+                with profiler.section('collect_polygons'):
+                    polygons = [(catid2idx[cat_id], seg) for cat_id, seg in first_polygons(img_id)
+                                if len(seg) >= 6 and len(seg) % 2 == 0]
+
+                #In tar mode, pack the image and its labels into the current shard.
+                if shard_writer is not None:
+                    pack_yolo_sample(shard_writer, src_img_path, format_yolo_labels(polygons, w, h))
+                    continue
+
+                #In incremental mode, skip images whose source and labels are unchanged.
+                if manifest is not None:
+                    inputs = [str(src_img_path)] if src_img_path.exists() else []
+                    key = data_digest([w, h, [(cls_idx, np.asarray(seg, dtype=np.float64).tolist())
+                                              for cls_idx, seg in polygons]])
+                    if manifest.is_fresh(fname, inputs, key):
+                        skipped += 1
+                        continue
+                    outputs = ([str(dst_img_path)] if inputs else []) + [str(label_path)]
+                    pending[str(label_path)] = (fname, describe_files(inputs), outputs, key)
+
+                #Place image file in YOLO structure.
+                if src_img_path.exists():
+                    with profiler.section('place_image'):
+                        place_image(src_img_path, dst_img_path, link_mode)
+                else:
+                    print(f"Warning: Source image not found: {src_img_path}")
+
+                label_tasks.append((label_path, polygons, w, h))
+
+        #Write the label files, in a process pool if requested.
+        try:
+            if workers > 1:
+                with Pool(processes=workers) as pool:
+                    written = pool.imap_unordered(profiler.task(write_yolo_label), label_tasks, chunksize=64)
+                    for label_path in profiler.collect(written):
+                        if manifest is not None:
+                            manifest.record(*pending.pop(str(label_path)))
             else:
-                print(f"Warning: Source image not found: {src_img_path}")
-            
-            #Convert annotations to YOLO segmentation format.
-            label_path = Path(output_root) / "labels" / split / f"{Path(fname).stem}.txt"
-            with open(label_path, "w") as f:
-                for ann in annos.get(img_id, []):
-                    cls_idx = catid2idx[ann["category_id"]]
-                    
-                    #Convert segmentation coordinates to normalized YOLO format.
-                    if ann.get("segmentation") and len(ann["segmentation"]) > 0:
-                        seg = ann["segmentation"][0]
-                        if len(seg) >= 6 and len(seg) % 2 == 0:
-                            seg_n = [coord / w if i % 2 == 0 else coord / h for i, coord in enumerate(seg)]
-                            
-                            parts = [str(cls_idx)]
-                            parts += [f"{v:.6f}" for v in seg_n]
-                            f.write(" ".join(parts) + "\n")
+                for task in label_tasks:
+                    label_path = write_yolo_label(task)
+                    if manifest is not None:
+                        manifest.record(*pending.pop(str(label_path)))
+            if manifest is not None:
+                #Remove images and labels of patches that are no longer in the dataset.
+                manifest.prune(img_info["file_name"] for img_info in images.values())
+        finally:
+            if manifest is not None:
+                manifest.close()
+                print(f"Skipped {skipped} unchanged images in '{split}' split.")
+            if shard_writer is not None:
+                shard_writer.close()
 
     #Process test split which only has images, and no annotations.
     print("Processing 'test' split...")
     test_json_path = Path(input_root) / "test" / "instancesonly_filtered_test.json"
     if test_json_path.exists():
-        with open(test_json_path, 'r') as f:
+        with profiler.section('json_load'), open(test_json_path, 'r') as f:
             test_data = json.load(f)
-        for img in test_data["images"]:
-            fname = img["file_name"]
-
-            #Copy the test images.
-            src_img_path = Path(input_root) / "test" / "images" / fname
-            dst_img_path = Path(output_root) / "images" / "test" / fname
-            
-            if src_img_path.exists():
-                shutil.copy(src_img_path, dst_img_path)
-            else:
-                print(f"Warning: Source image not found: {src_img_path}")
-                
-            #Create empty label files for test images.
-            label_path = Path(output_root) / "labels" / "test" / f"{Path(fname).stem}.txt"
-            with open(label_path, "w") as f:
-                pass
+        manifest = open_manifest(output_root, "test", {"link_mode": link_mode}, incremental)
+        shard_writer = open_shard_writer(output_root, "test", output_format, shard_size)
+        skipped = 0
+        try:
+            profiler.start_progress()
+            for i, img in enumerate(test_data["images"], 1):
+                profiler.progress(i, len(test_data["images"]))
+                fname = img["file_name"]
+                with profiler.image(fname):
+                    src_img_path = Path(input_root) / "test" / "images" / fname
+                    dst_img_path = Path(output_root) / "images" / "test" / fname
+                    label_path = Path(output_root) / "labels" / "test" / f"{Path(fname).stem}.txt"
+
+                    #In tar mode, pack the image with an empty label file.
+                    if shard_writer is not None:
+                        pack_yolo_sample(shard_writer, src_img_path, "")
+                        continue
+
+                    #In incremental mode, skip test images that are unchanged.
+                    if manifest is not None:
+                        inputs = [str(src_img_path)] if src_img_path.exists() else []
+                        if manifest.is_fresh(fname, inputs):
+                            skipped += 1
+                            continue
+                        described = describe_files(inputs)
+
+                    #Place the test images.
+                    if src_img_path.exists():
+                        with profiler.section('place_image'):
+                            place_image(src_img_path, dst_img_path, link_mode)
+                    else:
+                        print(f"Warning: Source image not found: {src_img_path}")
+                    
+                    #Create empty label files for test images.
+                    with profiler.section('write_label'), open(label_path, "w") as f:
+                        pass
+
+                    if manifest is not None:
+                        outputs = [str(dst_img_path)] if inputs else []
+                        manifest.record(fname, described, outputs + [str(label_path)])
+            if manifest is not None:
+                manifest.prune(img["file_name"] for img in test_data["images"])
+        finally:
+            if manifest is not None:
+                manifest.close()
+                print(f"Skipped {skipped} unchanged images in 'test' split.")
+            if shard_writer is not None:
+                shard_writer.close()
 
     #Create YOLO dataset .yml configuration file.
     print("Writing data.yaml file...")
     train_json_path = Path(input_root) / "train" / "instancesonly_filtered_train.json"
-    if train_json_path.exists():
+    train_store_path = train_json_path.with_suffix(".store")
+    categories = None
+    if annotation_store and train_store_path.exists():
+        with open(train_store_path / "meta.json", 'r') as f:
+            categories = json.load(f)["categories"]
+    elif train_json_path.exists():
         with open(train_json_path, 'r') as f:
-            train_data = json.load(f)
-        names = [c["name"] for c in sorted(train_data["categories"], key=lambda x: x["id"])]
+            categories = json.load(f)["categories"]
+    if categories is not None:
+        names = [c["name"] for c in sorted(categories, key=lambda x: x["id"])]
         
         yaml_path = Path(output_root) / "data.yaml"
         with open(yaml_path, "w") as f:
@@ -119,7 +349,10 @@ def convert_isaid_to_yolo_seg(input_root: str, output_root: str):
         print("Warning: Could not find train JSON file to extract class names for data.yaml")
     
     print("Conversion complete.")
+    if profile:
+        profiler.active().write_report(profile, 'convert_to_yolo')
 
 if __name__ == "__main__":
     args = parse_args()
-    convert_isaid_to_yolo_seg(args.datadir, args.outdir)
\ No newline at end of file
+    convert_isaid_to_yolo_seg(args.datadir, args.outdir, args.link_mode, args.workers, args.incremental,
+                              args.output_format, args.shard_size, args.annotation_store, args.profile)
\ No newline at end of file
@@ -5,8 +5,9 @@
 import argparse
 import json
 import os
-import cv2
 from natsort import natsorted
+from image_header import read_image_size
+import profiler
 
 def get_category_info():
     #Define the 16 object categories used in iSAID dataset.
@@ -24,6 +25,9 @@ def get_category_info():
 def main(args):
     #Process specified dataset splits.
     sets = args.set.split(',')
+    profile_path = getattr(args, 'profile', None)
+    if profile_path:
+        profiler.enable()
     
     for data_set in sets:
         if data_set != 'test':
@@ -41,21 +45,24 @@ def main(args):
         #Collect all test image information.
         images = []
         img_id = 0
+        profiler.start_progress()
         for root, _, files in os.walk(ann_dir):
-            for filename in natsorted(files):
-                if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+            for i, filename in enumerate(natsorted(files), 1):
+                profiler.progress(i, len(files), 'files')
+                if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
 
                     #Skip annotation/mask images, keep only original images.
                     if '_instance_color_RGB' in filename or '_instance_id_RGB' in filename:
                         continue
                         
-                    #Read image to get dimensions.
+                    #Read image dimensions from the file header.
                     img_path = os.path.join(root, filename)
-                    img = cv2.imread(img_path)
-                    if img is None:
+                    with profiler.image(filename), profiler.section('read_header'):
+                        size = read_image_size(img_path)
+                    if size is None:
                         print(f"Warning: failed to read {filename}")
                         continue
-                    h, w = img.shape[:2]
+                    h, w = size
                     
                     #Add image information to list.
                     images.append({
@@ -76,15 +83,21 @@ def main(args):
         #Write the test JSON file.
         os.makedirs(os.path.join(args.outdir, data_set), exist_ok=True)
         out_file = os.path.join(args.outdir, data_set, 'instancesonly_filtered_test.json')
-        with open(out_file, 'w') as f:
+        with profiler.section('json_write'), open(out_file, 'w') as f:
             json.dump(ann_dict, f, indent=4)
         print(f"Wrote {len(images)} test image entries to {out_file}")
 
+    if profile_path:
+        profiler.active().write_report(profile_path, 'generate_test_json')
+
 if __name__ == '__main__':
     #Parse command line arguments for directory paths.
     parser = argparse.ArgumentParser(description='Generate test image IDs JSON')
     parser.add_argument('--outdir', default='./iSAID_patches', type=str)
     parser.add_argument('--datadir', default='./iSAID_patches', type=str)
     parser.add_argument('--set', default="test", type=str)
+    parser.add_argument('--profile', nargs='?', const='profile_generate_test_json.json', default=None,
+                        help="Record time and call counts of the hot sections, per-image time and peak "
+                             "memory, and write a JSON report (default: profile_generate_test_json.json).")
     args = parser.parse_args()
     main(args)
\ No newline at end of file
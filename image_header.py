@@ -0,0 +1,104 @@
+#This module reads image dimensions from the PNG IHDR, JPEG SOF or WebP header without decoding pixels.
+#Files whose header cannot be parsed, or JPEGs carrying EXIF data (OpenCV applies their orientation
+#when decoding), fall back to a full cv2.imread so the result always matches the decoded image.
+
+import struct
+import cv2
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+#JPEG start-of-frame markers that carry the image dimensions (excluding DHT, JPG and DAC).
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                    0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def _png_size(f):
+    #The IHDR chunk must come first: length, type, then big-endian width and height.
+    header = f.read(24)
+    if len(header) < 24 or header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+        return None
+    width, height = struct.unpack('>II', header[16:24])
+    return height, width
+
+def _jpeg_size(f):
+    #Walk the marker segments up to the first start-of-frame segment.
+    if f.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        #Every segment starts with 0xFF, optionally followed by 0xFF fill bytes, then the marker.
+        if f.read(1) != b'\xff':
+            return None
+        marker = f.read(1)
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker == 0xD8 or 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            #Standalone markers without a length field.
+            continue
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack('>H', length_bytes)[0]
+        if marker in JPEG_SOF_MARKERS:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack('>HH', data[1:5])
+            return (height, width) if height and width else None
+        if marker == 0xE1 or marker in (0xD9, 0xDA):
+            #EXIF orientation would change the decoded shape; past SOS there is no header left.
+            return None
+        f.seek(length - 2, 1)
+
+def _webp_size(f):
+    #A RIFF container with a VP8 (lossy), VP8L (lossless) or VP8X (extended) first chunk.
+    header = f.read(30)
+    if len(header) < 30 or header[:4] != b'RIFF' or header[8:12] != b'WEBP':
+        return None
+    kind = header[12:16]
+    if kind == b'VP8X':
+        if header[20] & 0x08:
+            #EXIF data, which could carry an orientation.
+            return None
+        width = int.from_bytes(header[24:27], 'little') + 1
+        height = int.from_bytes(header[27:30], 'little') + 1
+    elif kind == b'VP8L':
+        if header[20] != 0x2f:
+            return None
+        bits = int.from_bytes(header[21:25], 'little')
+        width = (bits & 0x3fff) + 1
+        height = ((bits >> 14) & 0x3fff) + 1
+    elif kind == b'VP8 ':
+        if header[23:26] != b'\x9d\x01\x2a':
+            return None
+        width, height = struct.unpack('<HH', header[26:30])
+        width, height = width & 0x3fff, height & 0x3fff
+    else:
+        return None
+    return height, width
+
+def read_image_size(path):
+    #Return (height, width) of an image, or None if it cannot be read.
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(8)
+            f.seek(0)
+            if head == PNG_SIGNATURE:
+                size = _png_size(f)
+            elif head[:2] == b'\xff\xd8':
+                size = _jpeg_size(f)
+            elif head[:4] == b'RIFF':
+                size = _webp_size(f)
+            else:
+                size = None
+    except OSError:
+        size = None
+    if size is not None:
+        return size
+
+    #Fall back to a full decode for unusual files.
+    img = cv2.imread(path)
+    if img is None:
+        return None
+    return img.shape[:2]
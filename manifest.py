@@ -0,0 +1,132 @@
+#This module implements the manifest used for incremental rebuilds across the toolkit.
+#Each completed unit of work (a scene in split.py, a patch in preprocess.py, an image in
+#convert_to_yolo.py) is appended to a JSON-lines log together with the content hashes of its
+#inputs, the run parameters and the outputs it produced. Re-runs skip units whose record is
+#still valid, and since every record is flushed as soon as its unit finishes, an interrupted
+#run resumes where it stopped.
+
+import hashlib
+import json
+import os
+
+#Bump this when the output of a stage changes, so existing records are treated as stale.
+CACHE_VERSION = 1
+
+def file_digest(path, chunk_size=1 << 20):
+    #Return the SHA-1 hex digest of a file's contents.
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def describe_files(paths, known=None):
+    #Return {path: [size, mtime_ns, digest]} for the given files. Digests in known are
+    #reused when size and modification time are unchanged, so files are only re-read
+    #when they may actually have changed.
+    info = {}
+    for path in paths:
+        st = os.stat(path)
+        prev = known.get(path) if known else None
+        if prev is not None and prev[0] == st.st_size and prev[1] == st.st_mtime_ns:
+            digest = prev[2]
+        else:
+            digest = file_digest(path)
+        info[path] = [st.st_size, st.st_mtime_ns, digest]
+    return info
+
+def data_digest(obj):
+    #Return the SHA-1 hex digest of a JSON-serialisable object.
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+class Manifest:
+    #Append-only log of completed units of work for one stage and split.
+    def __init__(self, path, params):
+        self.path = path
+        self.params = json.loads(json.dumps(dict(params, cache_version=CACHE_VERSION), sort_keys=True))
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        #A torn last line left behind by an interrupted run.
+                        continue
+                    self.records[record['unit']] = record
+
+        #Rewrite the log with one record per unit before appending to it again.
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._rewrite()
+        self._file = open(path, 'a')
+
+    def _rewrite(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for record in self.records.values():
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def is_fresh(self, unit, inputs, key=None):
+        #Return True if unit was recorded with the same parameters, key and input contents,
+        #and all of its outputs still exist with their recorded sizes.
+        record = self.records.get(unit)
+        if record is None or record['params'] != self.params or record.get('key') != key:
+            return False
+        if sorted(record['inputs']) != sorted(inputs):
+            return False
+        try:
+            current = describe_files(inputs, record['inputs'])
+        except OSError:
+            return False
+        if any(current[p][2] != record['inputs'][p][2] for p in inputs):
+            return False
+        for path, size in record['outputs'].items():
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                return False
+        if current != record['inputs']:
+            #Same contents with a new timestamp: refresh the stats to avoid re-hashing next time.
+            self.record(unit, current, list(record['outputs']), key)
+        return True
+
+    def record(self, unit, inputs, outputs, key=None):
+        #Record a completed unit. inputs is the describe_files() result of its input files
+        #and outputs the list of files it wrote; outputs of a previous run of the unit that
+        #were not written again are removed, so stale files do not leak into later stages.
+        previous = self.records.get(unit)
+        if previous is not None:
+            for path in set(previous['outputs']) - set(outputs):
+                if os.path.exists(path):
+                    os.remove(path)
+        record = {
+            'unit': unit,
+            'params': self.params,
+            'key': key,
+            'inputs': inputs,
+            'outputs': {path: os.path.getsize(path) for path in outputs},
+        }
+        self.records[unit] = record
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def prune(self, units):
+        #Forget every unit not in units and remove its outputs, e.g. patches of a scene
+        #that was deleted or of a patch size that is no longer used.
+        units = set(units)
+        stale = [unit for unit in self.records if unit not in units]
+        for unit in stale:
+            for path in self.records.pop(unit)['outputs']:
+                if os.path.exists(path):
+                    os.remove(path)
+        return len(stale)
+
+    def close(self):
+        #Close the log, leaving one record per unit.
+        self._file.close()
+        self._rewrite()
@@ -0,0 +1,14 @@
+#This module holds the process-pool helper shared by the toolkit scripts.
+
+from collections import deque
+
+def imap_bounded(pool, func, items, window):
+    #Ordered pool.imap that keeps at most window tasks in flight, so finished results
+    #never pile up in memory while an earlier, slower task is still running.
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
@@ -0,0 +1,104 @@
+#This module serves iSAID patches on demand from the window index written by split.py --virtual.
+#No patch files are needed: each item is cropped from its source scene when requested. Scenes are
+#either kept decoded in a small LRU cache, or, when a cache directory is given, decoded once into
+#.npy files that are memory-mapped so only the rows a crop touches are read from disk.
+#The class implements __len__ and __getitem__, so it can be wrapped by a PyTorch DataLoader.
+
+import json
+import os
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+class VirtualPatchDataset:
+    def __init__(self, index_path, suffixes=('',), cache_dir=None, max_cached_scenes=2):
+        #index_path: windows_<split>.json written by split.py --virtual.
+        #suffixes: variants to load for every patch ('' is the RGB image, e.g. '_instance_id_RGB').
+        #cache_dir: if set, scenes are decoded once to .npy files there and memory-mapped.
+        #max_cached_scenes: number of decoded scenes kept in memory per suffix without cache_dir.
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        self.index_dir = os.path.dirname(os.path.abspath(index_path))
+        self.suffixes = list(suffixes)
+        self.cache_dir = cache_dir
+        self.max_cached_scenes = max_cached_scenes
+        self.scenes = index['scenes']
+
+        #Flatten the windows of all scenes into two arrays instead of millions of Python tuples.
+        counts = [len(scene['windows']) for scene in self.scenes]
+        self.scene_of = np.repeat(np.arange(len(self.scenes), dtype=np.int32), counts)
+        windows = [window for scene in self.scenes for window in scene['windows']]
+        self.windows = np.array(windows, dtype=np.int32).reshape(-1, 4)
+        self._open_scenes = OrderedDict()
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getstate__(self):
+        #Decoded and memory-mapped scenes are not sent to DataLoader worker processes.
+        state = self.__dict__.copy()
+        state['_open_scenes'] = OrderedDict()
+        return state
+
+    def file_name(self, i):
+        #Return the patch file name split.py would have written for item i (RGB variant).
+        return self._file_name(i, '')
+
+    def _file_name(self, i, suf):
+        scene = self.scenes[self.scene_of[i]]
+        src = scene['files'][suf]
+        if not scene['tiled']:
+            return os.path.basename(src)
+        y0, y1, x0, x1 = self.windows[i].tolist()
+        return f"{scene['base']}_{y0}_{y1}_{x0}_{x1}{suf}{os.path.splitext(src)[1]}"
+
+    def _scene(self, scene_idx, suf):
+        #Return the decoded (or memory-mapped) array of one scene variant.
+        key = (scene_idx, suf)
+        if key in self._open_scenes:
+            self._open_scenes.move_to_end(key)
+            return self._open_scenes[key]
+
+        src = os.path.join(self.index_dir, self.scenes[scene_idx]['files'][suf])
+        if self.cache_dir is not None:
+            array = self._memmap(src)
+        else:
+            array = cv2.imread(src)
+            if array is None:
+                raise IOError(f"Could not read scene: {src}")
+
+        self._open_scenes[key] = array
+        limit = self.max_cached_scenes * len(self.suffixes)
+        while len(self._open_scenes) > limit:
+            self._open_scenes.popitem(last=False)
+        return array
+
+    def _memmap(self, src):
+        #Decode a scene once into the cache directory and memory-map it. The cache file name
+        #includes the source size and modification time, so a changed scene is decoded again.
+        st = os.stat(src)
+        name = os.path.splitext(os.path.basename(src))[0]
+        npy_path = os.path.join(self.cache_dir, f"{name}_{st.st_size}_{st.st_mtime_ns}.npy")
+        if not os.path.exists(npy_path):
+            array = cv2.imread(src)
+            if array is None:
+                raise IOError(f"Could not read scene: {src}")
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = npy_path + f".{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, npy_path)
+        return np.load(npy_path, mmap_mode='r')
+
+    def __getitem__(self, i):
+        #Return (file_name, patches) where patches maps every requested suffix to its crop.
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        scene_idx = int(self.scene_of[i])
+        y0, y1, x0, x1 = self.windows[i].tolist()
+        patches = {}
+        for suf in self.suffixes:
+            patches[suf] = np.ascontiguousarray(self._scene(scene_idx, suf)[y0:y1, x0:x1])
+        return self.file_name(i), patches
@@ -0,0 +1,113 @@
+#This module encodes the patches written by split.py. The output format (the source's own,
+#PNG or lossless WebP) and the PNG compression level are configurable, and the encodes can run
+#on a bounded pool of threads: OpenCV releases the GIL while encoding, so cropping the next
+#patches overlaps with encoding the previous ones. Encoded sizes and times are accumulated so
+#the size/speed tradeoff of a setting can be reported.
+
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import profiler
+
+#'same' keeps the extension of the source image.
+FORMATS = ('same', 'png', 'webp')
+
+def output_ext(src_ext, fmt):
+    #Return the extension patches of a source with extension src_ext are written with.
+    return src_ext if fmt == 'same' else f'.{fmt}'
+
+def encode_params(ext, png_compression=None):
+    #Return the cv2.imencode parameters for an output extension. Unless a setting is given, no
+    #parameters are passed, so the output is the same as with OpenCV's defaults.
+    if ext == '.png' and png_compression is not None:
+        return [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    if ext == '.webp':
+        #A quality above 100 selects lossless WebP, so masks keep their exact instance ids.
+        return [cv2.IMWRITE_WEBP_QUALITY, 101]
+    return []
+
+def new_stats():
+    return {'patches': 0, 'raw_bytes': 0, 'encoded_bytes': 0, 'seconds': 0.0}
+
+def merge_stats(total, stats):
+    for key, value in stats.items():
+        total[key] += value
+
+def encode_patch(patch, ext, params, out_path=None):
+    #Encode one patch, and write it to out_path if given. Returns (encoded bytes, seconds).
+    #The encode section is recorded here, once per patch, also when it runs on an encoder thread.
+    start = time.perf_counter()
+    with profiler.section('encode'):
+        ok, buf = cv2.imencode(ext, patch, params)
+        if not ok:
+            raise IOError(f"Could not encode patch as {ext}")
+        data = buf.tobytes()
+        if out_path is not None:
+            with open(out_path, 'wb') as f:
+                f.write(data)
+    return data, time.perf_counter() - start
+
+class PatchEncoder:
+    #Encodes patches in submission order. With threads > 0, at most 2 * threads encodes are
+    #pending at a time, which bounds the memory held by patches waiting to be encoded.
+    def __init__(self, threads=0):
+        self.threads = threads
+        self.stats = new_stats()
+        self._pool = ThreadPoolExecutor(max_workers=threads) if threads > 0 else None
+        self._pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _finish(self, tag, patch, result):
+        data, seconds = result
+        self.stats['patches'] += 1
+        self.stats['raw_bytes'] += patch.nbytes
+        self.stats['encoded_bytes'] += len(data)
+        self.stats['seconds'] += seconds
+        return tag, data
+
+    def submit(self, tag, patch, ext, params, out_path=None):
+        #Queue a patch for encoding. Returns the (tag, encoded bytes) pairs of the patches that
+        #are finished, in submission order; the last ones are returned by flush().
+        if self._pool is None:
+            return [self._finish(tag, patch, encode_patch(patch, ext, params, out_path))]
+        self._pending.append((tag, patch, self._pool.submit(encode_patch, patch, ext, params, out_path)))
+        done = []
+        while len(self._pending) >= 2 * self.threads or (self._pending and self._pending[0][2].done()):
+            tag, patch, future = self._pending.popleft()
+            with profiler.section('encode_wait'):
+                result = future.result()
+            done.append(self._finish(tag, patch, result))
+        return done
+
+    def flush(self):
+        #Wait for all pending encodes and return their results in submission order.
+        done = []
+        while self._pending:
+            tag, patch, future = self._pending.popleft()
+            with profiler.section('encode_wait'):
+                result = future.result()
+            done.append(self._finish(tag, patch, result))
+        return done
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+def report_encoding(stats, description, threads):
+    #Print the size and speed of the encoded patches.
+    if not stats['patches']:
+        return
+    raw_mb = stats['raw_bytes'] / 2**20
+    encoded_mb = stats['encoded_bytes'] / 2**20
+    ratio = 100.0 * stats['encoded_bytes'] / stats['raw_bytes'] if stats['raw_bytes'] else 0.0
+    rate = raw_mb / stats['seconds'] if stats['seconds'] > 0 else 0.0
+    mode = f"{threads} encoder threads" if threads > 0 else "inline"
+    print(f"  Encoded {stats['patches']} patches ({description}, {mode}): {raw_mb:.1f} MB raw -> "
+          f"{encoded_mb:.1f} MB ({ratio:.1f}%), {stats['seconds']:.1f}s encoding, {rate:.1f} MB/s per thread")
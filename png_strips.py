@@ -0,0 +1,176 @@
+#This module decodes PNG images in horizontal strips, so a very large scene can be tiled while
+#only a band of rows is held in memory. The IDAT stream is inflated incrementally, and the
+#filtered scanlines of each strip are wrapped in a small PNG that OpenCV decodes. That PNG starts
+#with the last reconstructed row of the previous strip, stored unfiltered, so the Up, Average and
+#Paeth filters of the strip's first row see the correct previous row. The rows are identical to
+#the same rows of cv2.imread(path). Images this does not cover (JPEG, interlaced, palette or
+#16-bit PNG) are decoded in full with cv2.imread instead.
+
+import struct
+import zlib
+import cv2
+import numpy as np
+from image_header import PNG_SIGNATURE
+
+#Channels of the supported 8-bit colour types: greyscale, RGB and RGBA.
+PNG_CHANNELS = {0: 1, 2: 3, 6: 4}
+
+def _chunk(kind, data):
+    crc = zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff
+    return b''.join([struct.pack('>I', len(data)), kind, data, struct.pack('>I', crc)])
+
+class StripReader:
+    def __init__(self, path, strip_rows=256, read_size=1 << 20):
+        #Open an image for strip decoding. height and width are read from the header; rows are
+        #only decoded when requested with rows(). strip_rows is the minimum number of rows
+        #decoded at a time, read_size the number of compressed bytes read at a time.
+        self.path = path
+        self.strip_rows = strip_rows
+        self.read_size = read_size
+        self.streaming = False
+        self._full = None
+        self._buf = None
+        self._buf_start = 0
+        self._next_row = 0
+        self._file = open(path, 'rb')
+        try:
+            self.streaming = self._read_header()
+        except (OSError, struct.error, ValueError):
+            self.streaming = False
+        if not self.streaming:
+            self._file.close()
+            self._full = cv2.imread(path)
+            if self._full is None:
+                raise IOError(f"Could not read image: {path}")
+            self.height, self.width = self._full.shape[:2]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _read_header(self):
+        #Parse the chunks up to the first IDAT. Returns False for PNGs that are not decoded in strips.
+        f = self._file
+        if f.read(8) != PNG_SIGNATURE:
+            return False
+        while True:
+            length, kind = struct.unpack('>I4s', f.read(8))
+            if kind == b'IHDR':
+                data = f.read(length)
+                f.seek(4, 1)
+                width, height, depth, color, _, _, interlace = struct.unpack('>IIBBBBB', data)
+                if depth != 8 or color not in PNG_CHANNELS or interlace != 0:
+                    return False
+                self.width, self.height, self.color = width, height, color
+                self.channels = PNG_CHANNELS[color]
+                self.stride = width * self.channels
+            elif kind == b'tRNS':
+                return False
+            elif kind == b'IDAT':
+                self._chunk_left = length
+                break
+            elif kind == b'IEND':
+                return False
+            else:
+                f.seek(length + 4, 1)
+        self._inflater = zlib.decompressobj()
+        self._tail = b''
+        self._raw = bytearray()
+        self._prev_row = bytes(self.stride)
+        return True
+
+    def _compressed(self):
+        #Return the next piece of the IDAT stream, up to read_size bytes, or b'' at its end.
+        #Encoders often write small IDAT chunks, so consecutive chunks are read together.
+        f = self._file
+        pieces, size = [], 0
+        while size < self.read_size and self._chunk_left is not None:
+            if self._chunk_left == 0:
+                f.seek(4, 1)
+                length, kind = struct.unpack('>I4s', f.read(8))
+                #None marks the end of the IDAT chunks.
+                self._chunk_left = length if kind == b'IDAT' else None
+                continue
+            data = f.read(min(self._chunk_left, self.read_size - size))
+            if not data:
+                raise IOError(f"Truncated PNG: {self.path}")
+            self._chunk_left -= len(data)
+            pieces.append(data)
+            size += len(data)
+        return b''.join(pieces)
+
+    def _inflate(self, nbytes):
+        #Inflate until at least nbytes of filtered scanlines are buffered. The output of each
+        #call is bounded, so a highly compressible image never inflates all at once.
+        while len(self._raw) < nbytes:
+            data = self._tail or self._compressed()
+            if not data:
+                raise IOError(f"Truncated PNG: {self.path}")
+            self._raw += self._inflater.decompress(data, nbytes - len(self._raw))
+            self._tail = self._inflater.unconsumed_tail
+
+    def _decode(self, count):
+        #Decode the next count rows and return them as in cv2.imread (BGR, uint8).
+        size = count * (self.stride + 1)
+        self._inflate(size)
+        #The strip is only stored, not compressed again: it is decoded right away.
+        deflate = zlib.compressobj(0)
+        with memoryview(self._raw) as raw:
+            idat = b''.join([deflate.compress(b'\x00' + self._prev_row),
+                             deflate.compress(raw[:size]), deflate.flush()])
+        del self._raw[:size]
+
+        ihdr = struct.pack('>IIBBBBB', self.width, count + 1, 8, self.color, 0, 0, 0)
+        png = PNG_SIGNATURE + _chunk(b'IHDR', ihdr) + _chunk(b'IDAT', idat) + _chunk(b'IEND', b'')
+        strip = cv2.imdecode(np.frombuffer(png, np.uint8), cv2.IMREAD_UNCHANGED)
+        if strip is None:
+            raise IOError(f"Could not decode PNG strip: {self.path}")
+        strip = strip[1:]
+        self._next_row += count
+
+        #Keep the last row in file channel order (RGB, RGBA or grey) for the next strip.
+        last = strip[-1]
+        if self.color == 2:
+            last = last[:, ::-1]
+        elif self.color == 6:
+            last = last[:, [2, 1, 0, 3]]
+        self._prev_row = np.ascontiguousarray(last).tobytes()
+
+        if self.color == 0:
+            return cv2.cvtColor(strip, cv2.COLOR_GRAY2BGR)
+        if self.color == 6:
+            return np.ascontiguousarray(strip[:, :, :3])
+        return strip
+
+    def rows(self, y0, y1):
+        #Return rows y0 to y1 as a BGR array. y0 must not decrease between calls: rows above y0
+        #are released, and only the rows up to y1 that are not buffered yet are decoded.
+        #The buffer always holds rows _buf_start to _next_row.
+        if self._full is not None:
+            return self._full[y0:y1]
+        if y0 < self._buf_start:
+            raise ValueError("StripReader rows must be requested in increasing order")
+        y1 = min(y1, self.height)
+        if self._buf is not None:
+            drop = min(y0, self._next_row) - self._buf_start
+            self._buf = self._buf[drop:]
+            self._buf_start += drop
+
+        #Rows between the buffered ones and y0 still have to be decoded, one strip at a time.
+        while self._next_row < y0:
+            self._decode(min(self.strip_rows, y0 - self._next_row))
+            self._buf, self._buf_start = None, self._next_row
+
+        if y1 > self._next_row:
+            count = min(max(y1 - self._next_row, self.strip_rows), self.height - self._next_row)
+            new = self._decode(count)
+            self._buf = new if self._buf is None else np.concatenate([self._buf, new])
+        return self._buf[y0 - self._buf_start:y1 - self._buf_start]
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        self._full = None
+        self._buf = None
@@ -4,11 +4,21 @@
 import argparse
 import os
 import json
+import shutil
+import tempfile
 import cv2
+from multiprocessing import Pool
+from operator import itemgetter
 import numpy as np
 from natsort import natsorted
 from pycocotools import mask as maskUtils
+from scipy import ndimage
 from skimage import measure
+from annotation_store import AnnotationStoreWriter
+from image_header import read_image_size
+from manifest import Manifest, describe_files
+from parallel import imap_bounded
+import profiler
 
 def parse_args():
     #Parse command line arguments for processing parameters.
@@ -16,7 +26,38 @@ def parse_args():
     parser.add_argument('--datadir', default='./iSAID_patches', type=str)
     parser.add_argument('--outdir', default='./iSAID_patches', type=str)
     parser.add_argument('--set', default="train,val", type=str)
-    return parser.parse_args()
+    parser.add_argument('--workers', default=1, type=int,
+                        help="Number of worker processes used to annotate patches.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Reuse cached annotations of patches that are unchanged since the last run.")
+    parser.add_argument('--compact', action='store_true',
+                        help="Write the JSON without indentation or whitespace.")
+    parser.add_argument('--precision', default=None, type=int,
+                        help="Round polygon coordinates to this many decimals.")
+    parser.add_argument('--binary_store', action='store_true',
+                        help="Also write the annotations to a memory-mappable binary store "
+                             "(instancesonly_filtered_<split>.store) next to the JSON file.")
+    parser.add_argument('--seg_format', default='polygon', choices=['polygon', 'rle'],
+                        help="Write segmentations as polygons or as compressed COCO RLE.")
+    parser.add_argument('--simplify_tolerance', default=0.0, type=float,
+                        help="Simplify polygons with Douglas-Peucker at this tolerance in pixels (0 disables).")
+    parser.add_argument('--min_iou', default=0.9, type=float,
+                        help="Keep the original polygons of an instance if the simplified ones have a "
+                             "lower mask IoU than this.")
+    parser.add_argument('--profile', nargs='?', const='profile_preprocess.json', default=None,
+                        help="Record time and call counts of the hot sections, per-patch time and peak "
+                             "memory, and write a JSON report (default: profile_preprocess.json).")
+    args = parser.parse_args()
+    if args.binary_store and args.seg_format == 'rle':
+        parser.error("--binary_store only supports --seg_format polygon")
+    return args
+
+def report_simplification(simplify_stats, min_iou):
+    #Print the vertex reduction of polygon simplification.
+    raw, kept, fallbacks = simplify_stats
+    ratio = kept / raw if raw else 1.0
+    print(f"Simplified polygons from {raw} to {kept} vertices ({ratio:.1%} kept); "
+          f"{fallbacks} instances kept their original polygons (IoU < {min_iou})")
 
 def get_category_info():
     #Define the 16 object categories used in iSAID dataset.
@@ -31,8 +72,384 @@ def get_category_info():
         {'id': 14, 'name': 'plane'}, {'id': 15, 'name': 'Harbor'}
     ]
 
+def decode_instance_map(instance_img):
+    #Decode instance IDs from RGB channels (iSAID specific encoding).
+    r_channel = instance_img[:, :, 2].astype(np.int32)
+    g_channel = instance_img[:, :, 1].astype(np.int32)
+    return (r_channel // 10 * 256) + g_channel
+
+def simplify_contours(contours, tolerance, min_iou):
+    #Simplify (x, y) contours with Douglas-Peucker. The simplified polygons are rasterised and
+    #compared with the raster of the original polygons; if their IoU is below min_iou the
+    #original contours are kept. Returns (contours, [raw vertices, kept vertices, 1 if the
+    #original contours were kept else 0]).
+    #Both steps run in a frame anchored at the contours, shifted by a whole number of pixels
+    #so they start at (1, 1) with a one pixel border around them. The result then does not
+    #depend on where the instance's crop was taken (patch or scene mode), and no polygon is
+    #clipped by the raster border.
+    raw = sum(len(contour) for contour in contours)
+    origin = np.floor(np.min([contour.min(axis=0) for contour in contours], axis=0)) - 1
+    shifted = [contour - origin for contour in contours]
+    extent = np.ceil(np.max([contour.max(axis=0) for contour in shifted], axis=0)).astype(int) + 2
+    with profiler.section('simplify'):
+        simplified = [measure.approximate_polygon(contour, tolerance) for contour in shifted]
+    #Drop fragments that collapsed below a triangle.
+    simplified = [contour for contour in simplified if len(contour) >= 3]
+    with profiler.section('simplify_iou'):
+        iou = polygon_iou(simplified, shifted, (extent[1], extent[0])) if simplified else 0.0
+    if simplified and iou >= min_iou:
+        return [contour + origin for contour in simplified], [raw, sum(len(contour) for contour in simplified), 0]
+    return contours, [raw, raw, 1]
+
+def polygon_iou(polys_a, polys_b, shape):
+    #IoU of the rasterised unions of two lists of (x, y) polygons.
+    h, w = shape
+    rles = []
+    for polys in (polys_a, polys_b):
+        flat = [poly.ravel().tolist() for poly in polys if len(poly) >= 3]
+        if not flat:
+            return 0.0
+        rles.append(maskUtils.merge(maskUtils.frPyObjects(flat, h, w)))
+    return float(maskUtils.iou([rles[0]], [rles[1]], [0])[0][0])
+
+def frame_rle(binary_mask, x0, y0, frame_h, frame_w):
+    #Return the compressed COCO RLE of a mask crop placed at (x0, y0) in a frame_h x frame_w
+    #frame. The column-major runs are computed from the crop's pixels, so the full frame is
+    #never allocated.
+    crop_h = binary_mask.shape[0]
+    idx = np.flatnonzero(binary_mask.T)
+    idx = (idx // crop_h + x0) * frame_h + idx % crop_h + y0
+    #Starts and ends of the runs of consecutive foreground indices.
+    breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+    starts = idx[np.concatenate(([0], breaks))]
+    ends = idx[np.concatenate((breaks - 1, [len(idx) - 1]))] + 1
+    counts = np.empty(2 * len(starts) + 1, dtype=np.int64)
+    counts[0] = starts[0]
+    counts[1:-1:2] = ends - starts
+    counts[2:-1:2] = starts[1:] - ends[:-1]
+    counts[-1] = frame_h * frame_w - ends[-1]
+    rle = maskUtils.frPyObjects({'counts': counts.tolist(), 'size': [frame_h, frame_w]}, frame_h, frame_w)
+    return {'size': [frame_h, frame_w], 'counts': rle['counts'].decode('ascii')}
+
+def trace_instance(binary_mask, seg_opts=None):
+    #Trace the contours of a binary mask crop and measure it, all in crop coordinates.
+    #Returns None if the mask has no contours, otherwise (segmentation, area, bbox, stats).
+    #segmentation is the list of (simplified) contours, or the mask crop itself in RLE mode;
+    #stats are the simplify_contours() vertex counts, or None if no simplification was done.
+    seg_opts = seg_opts or {}
+    rle_format = seg_opts.get('seg_format', 'polygon') == 'rle'
+    if not rle_format:
+        with profiler.section('find_contours'):
+            contours = measure.find_contours(binary_mask, 0.5)
+        if not contours:
+            return None
+
+    #Calculate area and bounding box using COCO tools.
+    with profiler.section('mask_encode'):
+        rle = maskUtils.encode(np.asfortranarray(binary_mask))
+        area = float(maskUtils.area(rle))
+        bbox = maskUtils.toBbox(rle).tolist()
+    if rle_format:
+        return binary_mask, area, bbox, None
+
+    contours = [np.flip(contour, axis=1) for contour in contours]
+    stats = None
+    if seg_opts.get('simplify_tolerance', 0) > 0:
+        contours, stats = simplify_contours(contours, seg_opts['simplify_tolerance'],
+                                            seg_opts.get('min_iou', 0.0))
+    return contours, area, bbox, stats
+
+def place_instance(class_id, traced, x0, y0, frame_shape):
+    #Build the annotation fields of a traced instance whose crop starts at (x0, y0) in a
+    #frame of frame_shape (height, width).
+    segmentation, area, bbox, stats = traced
+    if isinstance(segmentation, np.ndarray):
+        with profiler.section('rle_frame'):
+            segmentation = frame_rle(segmentation, x0, y0, *frame_shape)
+    else:
+        segmentation = [(contour + (x0, y0)).ravel().tolist() for contour in segmentation]
+    instance = {
+        'category_id': int(class_id),
+        'segmentation': segmentation,
+        'area': area,
+        'bbox': [bbox[0] + x0, bbox[1] + y0, bbox[2], bbox[3]],
+    }
+    if stats is not None:
+        #Only used for the simplification report; not written to the annotation file.
+        instance['simplify_stats'] = stats
+    return instance
+
+def valid_class(instance_id, num_categories):
+    #Extract class ID from instance ID, or return 0 for background and unknown classes.
+    class_id = instance_id // 1000
+    if instance_id == 0 or class_id > num_categories - 1:
+        return 0
+    return class_id
+
+def extract_instances(instance_map, num_categories, seg_opts=None):
+    #Extract the segmentation, area and bounding box of every instance in a decoded instance map.
+    #All instances are labelled in one pass over the map, after which each instance is only
+    #processed inside its bounding-box crop and the coordinates are shifted back to the frame.
+    h, w = instance_map.shape
+    with profiler.section('label_instances'):
+        pixel_counts = np.bincount(instance_map.ravel())
+        boxes = ndimage.find_objects(instance_map)
+
+    instances = []
+    for instance_id in np.flatnonzero(pixel_counts):
+        class_id = valid_class(instance_id, num_categories)
+        if class_id == 0: continue
+
+        #Skip very small instances.
+        if pixel_counts[instance_id] < 10: continue
+
+        #Crop the binary mask to the bounding box plus a one pixel border, so contours
+        #close exactly as they would on the full frame.
+        rows, cols = boxes[instance_id - 1]
+        y0, y1 = max(rows.start - 1, 0), min(rows.stop + 1, h)
+        x0, x1 = max(cols.start - 1, 0), min(cols.stop + 1, w)
+        binary_mask = (instance_map[y0:y1, x0:x1] == instance_id).astype(np.uint8)
+
+        traced = trace_instance(binary_mask, seg_opts)
+        if traced is None: continue
+        instances.append(place_instance(class_id, traced, x0, y0, (h, w)))
+    return instances
+
+def extract_window_instances(instance_map, windows, num_categories, seg_opts=None):
+    #Annotate every (y0, y1, x0, x1) window of a full scene, returning one instance list per
+    #window, each equal to extract_instances() on that window's crop of the instance map.
+    #Instances are labelled once for the whole scene. An instance whose padded crop lies inside
+    #a window is traced once and reused for every such window; only instances cut by a window
+    #border are traced again, on their clipped crop, with the same < 10 pixel rule.
+    h, w = instance_map.shape
+    with profiler.section('label_instances'):
+        pixel_counts = np.bincount(instance_map.ravel())
+        boxes = ndimage.find_objects(instance_map)
+
+    ids, class_ids, regions = [], [], []
+    for instance_id in np.flatnonzero(pixel_counts):
+        class_id = valid_class(instance_id, num_categories)
+        if class_id == 0: continue
+        rows, cols = boxes[instance_id - 1]
+        ids.append(instance_id)
+        class_ids.append(class_id)
+        regions.append((rows.start, rows.stop, cols.start, cols.stop))
+    regions = np.array(regions, dtype=np.int64).reshape(-1, 4)
+    #Bounding boxes padded by one pixel, clipped to the scene.
+    padded = np.stack([np.maximum(regions[:, 0] - 1, 0), np.minimum(regions[:, 1] + 1, h),
+                       np.maximum(regions[:, 2] - 1, 0), np.minimum(regions[:, 3] + 1, w)], axis=1)
+
+    traced_cache = {}
+    results = []
+    for wy0, wy1, wx0, wx1 in windows:
+        instances = []
+        hits = np.flatnonzero((regions[:, 0] < wy1) & (regions[:, 1] > wy0) &
+                              (regions[:, 2] < wx1) & (regions[:, 3] > wx0))
+        for k in hits:
+            instance_id, class_id = ids[k], class_ids[k]
+            py0, py1, px0, px1 = padded[k]
+            if py0 >= wy0 and py1 <= wy1 and px0 >= wx0 and px1 <= wx1:
+                #The whole instance lies in this window: trace it once for the scene.
+                if pixel_counts[instance_id] < 10: continue
+                if instance_id not in traced_cache:
+                    binary_mask = (instance_map[py0:py1, px0:px1] == instance_id).astype(np.uint8)
+                    traced_cache[instance_id] = trace_instance(binary_mask, seg_opts)
+                traced = traced_cache[instance_id]
+                y0, x0 = py0, px0
+            else:
+                #The window cuts the instance: trace the clipped crop.
+                y0, y1 = max(regions[k, 0] - 1, wy0), min(regions[k, 1] + 1, wy1)
+                x0, x1 = max(regions[k, 2] - 1, wx0), min(regions[k, 3] + 1, wx1)
+                binary_mask = (instance_map[y0:y1, x0:x1] == instance_id).astype(np.uint8)
+                if binary_mask.sum() < 10: continue
+                traced = trace_instance(binary_mask, seg_opts)
+            if traced is None: continue
+            instances.append(place_instance(class_id, traced, int(x0 - wx0), int(y0 - wy0),
+                                            (wy1 - wy0, wx1 - wx0)))
+        results.append(instances)
+    return results
+
+class CocoJsonWriter:
+    #Streams a COCO annotation file to disk as images and annotations arrive, so memory
+    #stays flat regardless of dataset size. Images are written straight to the output,
+    #annotations are spooled to a temporary file and appended when the writer is closed.
+    #With the default indent the output is identical to json.dump(coco_dict, f, indent=4).
+    def __init__(self, path, categories, indent=4, precision=None):
+        self.path = path
+        self.categories = categories
+        self.indent = indent
+        self.precision = precision
+        self.num_images = 0
+        self.num_annotations = 0
+        self._tmp_path = path + '.tmp'
+        self._file = open(self._tmp_path, 'w')
+        self._spool = tempfile.TemporaryFile('w+', dir=os.path.dirname(os.path.abspath(path)))
+        self._file.write('{')
+        self._open_list(self._file, 'images')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _dumps(self, obj, level):
+        #Serialise one object at the given nesting level of the output document.
+        if self.indent is None:
+            return json.dumps(obj, separators=(',', ':'))
+        pad = ' ' * (self.indent * level)
+        return pad + json.dumps(obj, indent=self.indent).replace('\n', '\n' + pad)
+
+    def _open_list(self, f, key):
+        if self.indent is None:
+            f.write(f'"{key}":[')
+        else:
+            f.write('\n' + ' ' * self.indent + f'"{key}": [')
+
+    def _close_list(self, f, count):
+        if self.indent is None or count == 0:
+            f.write(']')
+        else:
+            f.write('\n' + ' ' * self.indent + ']')
+
+    def _write_item(self, f, obj, index):
+        if index > 0:
+            f.write(',')
+        if self.indent is not None:
+            f.write('\n')
+        f.write(self._dumps(obj, 2))
+
+    def add_image(self, image):
+        self._write_item(self._file, image, self.num_images)
+        self.num_images += 1
+
+    def add_annotation(self, annotation):
+        #Write one annotation and return it as written, i.e. with rounded coordinates.
+        if self.precision is not None and isinstance(annotation['segmentation'], list):
+            annotation = dict(annotation)
+            annotation['segmentation'] = [[round(v, self.precision) for v in poly]
+                                          for poly in annotation['segmentation']]
+        self._write_item(self._spool, annotation, self.num_annotations)
+        self.num_annotations += 1
+        return annotation
+
+    def add_patch(self, file_name, width, height, instances):
+        #Add one image and its instances, assigning image and annotation ids sequentially.
+        #Returns the image entry and the annotations as written.
+        image = {
+            'id': self.num_images,
+            'width': width,
+            'height': height,
+            'file_name': file_name,
+        }
+        self.add_image(image)
+        annotations = []
+        for instance in instances:
+            annotations.append(self.add_annotation({
+                'id': self.num_annotations,
+                'image_id': image['id'],
+                'category_id': instance['category_id'],
+                'segmentation': instance['segmentation'],
+                'area': instance['area'],
+                'bbox': instance['bbox'],
+                'iscrowd': 0
+            }))
+        return image, annotations
+
+    def close(self):
+        #Append the spooled annotations and the categories, then move the file into place.
+        f = self._file
+        self._close_list(f, self.num_images)
+        f.write(',')
+        self._open_list(f, 'annotations')
+        self._spool.seek(0)
+        shutil.copyfileobj(self._spool, f)
+        self._spool.close()
+        self._close_list(f, self.num_annotations)
+        f.write(',')
+        self._open_list(f, 'categories')
+        for i, category in enumerate(self.categories):
+            self._write_item(f, category, i)
+        self._close_list(f, len(self.categories))
+        f.write('}' if self.indent is None else '\n}')
+        f.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        #Discard a partially written file.
+        self._spool.close()
+        self._file.close()
+        os.remove(self._tmp_path)
+
+def patch_paths(img_file, patch_dir):
+    #Return the image and instance ID mask paths of a patch. Masks are PNGs, or lossless WebP
+    #when split.py was run with --mask_format webp.
+    base_name, img_ext = os.path.splitext(img_file)
+    ins_path = os.path.join(patch_dir, f"{base_name}_instance_id_RGB.png")
+    if not os.path.exists(ins_path):
+        webp_path = os.path.join(patch_dir, f"{base_name}_instance_id_RGB.webp")
+        if os.path.exists(webp_path):
+            ins_path = webp_path
+    return os.path.join(patch_dir, img_file), ins_path
+
+def process_patch(img_file, patch_dir, num_categories, seg_opts=None):
+    #Annotate a single patch. Returns None if the patch should be skipped, otherwise
+    #(file_name, width, height, instances) with the instances still missing their ids.
+    img_path, ins_path = patch_paths(img_file, patch_dir)
+
+    #Skip if instance mask does not exist.
+    if not os.path.exists(ins_path):
+        return None
+
+    #Read the original image size from its header.
+    with profiler.section('read_header'):
+        size = read_image_size(img_path)
+    if size is None:
+        print(f"Could not read image: {img_path}")
+        return None
+    h, w = size
+
+    #Read the instance ID mask.
+    with profiler.section('imread'):
+        instance_img = cv2.imread(ins_path)
+    if instance_img is None:
+        print(f"Could not read instance image: {ins_path}")
+        return img_file, w, h, []
+
+    with profiler.section('decode_instance_map'):
+        instance_map = decode_instance_map(instance_img)
+    return img_file, w, h, extract_instances(instance_map, num_categories, seg_opts)
+
+def _process_patch_task(task):
+    #Run process_patch for a pool task, or load its cached result in incremental mode.
+    #Returns (file_name, cache_path, result, input descriptions of a freshly computed result).
+    img_file, patch_dir, num_categories, seg_opts, cache_path, fresh = task
+    if fresh:
+        with profiler.section('cache_read'), open(cache_path, 'r') as f:
+            return img_file, cache_path, json.load(f), None
+    inputs = None
+    if cache_path is not None:
+        inputs = describe_files([p for p in patch_paths(img_file, patch_dir) if os.path.exists(p)])
+    result = process_patch(img_file, patch_dir, num_categories, seg_opts)
+    if cache_path is not None:
+        with profiler.section('cache_write'), open(cache_path, 'w') as f:
+            json.dump(result, f)
+    return img_file, cache_path, result, inputs
+
 def main(args):
     categories = get_category_info()
+    workers = max(1, getattr(args, 'workers', 1))
+    profile_path = getattr(args, 'profile', None)
+    if profile_path:
+        profiler.enable()
+    seg_opts = {
+        'seg_format': getattr(args, 'seg_format', 'polygon'),
+        'simplify_tolerance': getattr(args, 'simplify_tolerance', 0.0),
+        'min_iou': getattr(args, 'min_iou', 0.9),
+    }
 
     #Process each dataset split (train/val).
     for split in args.set.split(','):
@@ -42,113 +459,94 @@ def main(args):
             print(f"Directory not found: {patch_dir}")
             continue
 
-        #Initialize lists for COCO format data.
-        images = []
-        annotations = []
-        ann_id = 0
-        img_id = 0
-
         #Get all image files (excluding instance mask files).
         all_files = natsorted(os.listdir(patch_dir))
-        image_files = [f for f in all_files if f.lower().endswith(('.png', '.jpg', '.jpeg')) and '_instance_' not in f]
-
-        #Process each image and its corresponding instance mask.
-        for img_file in image_files:
-            base_name, img_ext = os.path.splitext(img_file)
-            ins_file = f"{base_name}_instance_id_RGB.png"
-            ins_path = os.path.join(patch_dir, ins_file)
-            img_path = os.path.join(patch_dir, img_file)
-
-            #Skip if instance mask does not exist.
-            if not os.path.exists(ins_path):
-                continue
-
-            #Read the original image.
-            img = cv2.imread(img_path)
-            if img is None:
-                print(f"Could not read image: {img_path}")
-                continue
-            h, w, _ = img.shape
-
-            #Add image info to COCO format.
-            images.append({
-                'id': img_id,
-                'width': w,
-                'height': h,
-                'file_name': img_file,
-            })
-
-            #Read the instance ID mask.
-            instance_img = cv2.imread(ins_path)
-            if instance_img is None:
-                print(f"Could not read instance image: {ins_path}")
-                img_id += 1
-                continue
-            
-            #Decode instance IDs from RGB channels (iSAID specific encoding).
-            r_channel = instance_img[:, :, 2].astype(np.int32)
-            g_channel = instance_img[:, :, 1].astype(np.int32)
-            instance_map = (r_channel // 10 * 256) + g_channel
-            
-            #Find all unique instance IDs in the image.
-            unique_instances = np.unique(instance_map)
-
-            #Process each instance to create annotations.
-            for instance_id in unique_instances:
-                if instance_id == 0: continue
-                
-                #Extract class ID from instance ID.
-                class_id = instance_id // 1000
-                if class_id == 0 or class_id > len(categories) - 1: continue
-                
-                #Create binary mask for this instance.
-                binary_mask = (instance_map == instance_id).astype(np.uint8)
-                
-                #Skip very small instances.
-                if binary_mask.sum() < 10: continue
+        image_files = [f for f in all_files if f.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')) and '_instance_' not in f]
 
-                #Extract contours for segmentation polygons.
-                contours = measure.find_contours(binary_mask, 0.5)
-                
-                segmentation = []
-                for contour in contours:
-                    contour = np.flip(contour, axis=1)
-                    segmentation.append(contour.ravel().tolist())
-                
-                if not segmentation: continue
-
-                #Calculate area and bounding box using COCO tools.
-                rle = maskUtils.encode(np.asfortranarray(binary_mask))
-                area = float(maskUtils.area(rle))
-                bbox = maskUtils.toBbox(rle).tolist()
-
-                #Add annotation in COCO format.
-                annotations.append({
-                    'id': ann_id,
-                    'image_id': img_id,
-                    'category_id': int(class_id),
-                    'segmentation': segmentation,
-                    'area': area,
-                    'bbox': bbox,
-                    'iscrowd': 0
-                })
-                ann_id += 1
-            img_id += 1
-
-        #Create final COCO format dictionary.
-        coco_dict = {
-            'images': images,
-            'annotations': annotations,
-            'categories': categories
-        }
-        
-        #Write the COCO format JSON file.
+        #In incremental mode, patches whose image, mask and parameters are unchanged
+        #reuse the annotations cached by the previous run.
+        manifest = None
+        reused = []
+        if getattr(args, 'incremental', False):
+            cache_dir = os.path.join(args.outdir, '.isaid_cache', f'preprocess_{split}')
+            os.makedirs(cache_dir, exist_ok=True)
+            manifest = Manifest(cache_dir + '.jsonl', dict(seg_opts, num_categories=len(categories)))
+
+        def make_task(img_file):
+            if manifest is None:
+                return img_file, patch_dir, len(categories), seg_opts, None, False
+            inputs = [p for p in patch_paths(img_file, patch_dir) if os.path.exists(p)]
+            fresh = manifest.is_fresh(img_file, inputs)
+            if fresh:
+                reused.append(img_file)
+            cache_path = os.path.join(cache_dir, img_file + '.json')
+            return img_file, patch_dir, len(categories), seg_opts, cache_path, fresh
+
+        tasks = (make_task(img_file) for img_file in image_files)
+        task = profiler.task(_process_patch_task, name=itemgetter(0))
+
+        #Stream the COCO format JSON file as results arrive.
         out_json_path = os.path.join(args.outdir, split, f'instancesonly_filtered_{split}.json')
         os.makedirs(os.path.dirname(out_json_path), exist_ok=True)
-        with open(out_json_path, 'w') as f:
-            json.dump(coco_dict, f, indent=4)
-        
-        print(f"Wrote {len(images)} images and {len(annotations)} annotations to {out_json_path}")
+        writer = CocoJsonWriter(out_json_path, categories,
+                                indent=None if getattr(args, 'compact', False) else 4,
+                                precision=getattr(args, 'precision', None))
+        store = None
+        if getattr(args, 'binary_store', False):
+            store = AnnotationStoreWriter(os.path.splitext(out_json_path)[0] + '.store', categories)
+
+        simplify_stats = [0, 0, 0]
+
+        #Annotate the patches, in a process pool if requested. Results are merged in
+        #natsorted file order, so image and annotation ids match a serial run.
+        if workers > 1:
+            pool = Pool(processes=workers)
+            results = imap_bounded(pool, task, tasks, workers * 4)
+        else:
+            pool = None
+            results = map(task, tasks)
+        profiler.start_progress()
+        try:
+            with writer:
+                for i, (img_file, cache_path, result, inputs) in enumerate(profiler.collect(results), 1):
+                    if inputs is not None:
+                        manifest.record(img_file, inputs, [cache_path])
+                    if result is not None:
+                        for instance in result[3]:
+                            for k, v in enumerate(instance.get('simplify_stats', ())):
+                                simplify_stats[k] += v
+                        with profiler.section('json_write'):
+                            image, annotations = writer.add_patch(*result)
+                        if store is not None:
+                            with profiler.section('store_write'):
+                                store.add_patch(image, annotations)
+                    profiler.progress(i, len(image_files), 'patches')
+            if store is not None:
+                store.close()
+            if manifest is not None:
+                manifest.prune(image_files)
+        except BaseException:
+            if store is not None:
+                store.abort()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if manifest is not None:
+                manifest.close()
+
+        if manifest is not None:
+            print(f"Reused cached annotations for {len(reused)} of {len(image_files)} patches")
+
+        print(f"Wrote {writer.num_images} images and {writer.num_annotations} annotations to {out_json_path}")
+        if store is not None:
+            print(f"Wrote {store.num_polygons} polygons ({store.num_coords // 2} vertices) to {store.path}")
+        if seg_opts['seg_format'] == 'polygon' and seg_opts['simplify_tolerance'] > 0:
+            report_simplification(simplify_stats, seg_opts['min_iou'])
+
+    if profile_path:
+        profiler.active().write_report(profile_path, 'preprocess')
 
 if __name__ == '__main__':
     args = parse_args()
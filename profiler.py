@@ -0,0 +1,286 @@
+#This module implements the --profile option of the toolkit scripts.
+#Hot sections (image decoding, contour tracing, RLE encoding, PNG encoding, JSON writing, ...)
+#are wrapped in section() blocks that record cumulative time and call counts, and every image
+#is wrapped in an image() block that records its time and peak memory. Both are no-ops until
+#enable() is called. Pool tasks wrapped with task() send their worker's statistics back with
+#each result, and collect() merges them in the main process.
+#Peak memory is the process's peak RSS while the image was processed, reset through
+#/proc/self/clear_refs on Linux. Elsewhere the peak memory traced by tracemalloc is used,
+#which only covers allocations made through Python and slows down allocation-heavy code.
+
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+_active = None
+#Sections can be timed from several threads, e.g. split.py's encoder threads.
+_section_lock = threading.Lock()
+
+class _NullBlock:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_BLOCK = _NullBlock()
+
+class _Section:
+    def __init__(self, totals):
+        self.totals = totals
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        with _section_lock:
+            self.totals[0] += seconds
+            self.totals[1] += 1
+        return False
+
+def _reset_peak_rss():
+    #Reset the peak RSS (VmHWM) of this process; Linux only.
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+def _peak_rss():
+    #Return the peak RSS (VmHWM) of this process in bytes.
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+def _memory_mode(track_memory):
+    #Choose how per-image peak memory is measured: 'rss', 'tracemalloc' or None.
+    if not track_memory:
+        return None
+    try:
+        _reset_peak_rss()
+        if _peak_rss() is not None:
+            return 'rss'
+    except OSError:
+        pass
+    return 'tracemalloc'
+
+class _Image:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.memory_mode == 'rss':
+            _reset_peak_rss()
+            self.base = 0
+        elif self.profiler.memory_mode == 'tracemalloc':
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+                self.base = tracemalloc.get_traced_memory()[0]
+            else:
+                #Before Python 3.9 the peak can only be reset together with the traces.
+                tracemalloc.clear_traces()
+                self.base = 0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        peak = None
+        if self.profiler.memory_mode == 'rss':
+            peak = _peak_rss()
+        elif self.profiler.memory_mode == 'tracemalloc':
+            peak = max(tracemalloc.get_traced_memory()[1] - self.base, 0)
+        self.profiler.add_image(self.name, seconds, peak)
+        return False
+
+class Profiler:
+    def __init__(self, track_memory=True, slowest=10, interval=10.0):
+        #track_memory: measure the peak memory of every image.
+        #slowest: number of slowest images kept for the report.
+        #interval: minimum number of seconds between two progress lines.
+        self.pid = os.getpid()
+        self.track_memory = track_memory
+        self.slowest = slowest
+        self.interval = interval
+        self.started = time.perf_counter()
+        self._progress_started = self.started
+        self._last_progress = self.started
+        self._reset()
+        self.memory_mode = _memory_mode(track_memory)
+        if self.memory_mode == 'tracemalloc' and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _reset(self):
+        self.sections = {}
+        self.images = []
+        self.num_images = 0
+        self.image_seconds = 0.0
+        self.max_image_memory = 0
+
+    def section(self, name):
+        totals = self.sections.get(name)
+        if totals is None:
+            totals = self.sections.setdefault(name, [0.0, 0])
+        return _Section(totals)
+
+    def image(self, name):
+        return _Image(self, name)
+
+    def add_image(self, name, seconds, peak):
+        self.num_images += 1
+        self.image_seconds += seconds
+        if peak is not None:
+            self.max_image_memory = max(self.max_image_memory, peak)
+        entry = (seconds, name, peak)
+        if len(self.images) < self.slowest:
+            heapq.heappush(self.images, entry)
+        elif entry > self.images[0]:
+            heapq.heapreplace(self.images, entry)
+
+    def take_stats(self):
+        #Return the statistics collected so far and start over, e.g. at the end of a pool task.
+        stats = {
+            'sections': self.sections,
+            'images': self.images,
+            'num_images': self.num_images,
+            'image_seconds': self.image_seconds,
+            'max_image_memory': self.max_image_memory,
+        }
+        self._reset()
+        return stats
+
+    def merge(self, stats):
+        #Add statistics returned by take_stats(), e.g. from a worker process.
+        for name, (seconds, calls) in stats['sections'].items():
+            totals = self.sections.setdefault(name, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += calls
+        self.num_images += stats['num_images']
+        self.image_seconds += stats['image_seconds']
+        self.max_image_memory = max(self.max_image_memory, stats['max_image_memory'])
+        for entry in stats['images']:
+            entry = tuple(entry)
+            if len(self.images) < self.slowest:
+                heapq.heappush(self.images, entry)
+            elif entry > self.images[0]:
+                heapq.heapreplace(self.images, entry)
+
+    def start_progress(self):
+        self._progress_started = self._last_progress = time.perf_counter()
+
+    def progress(self, done, total, unit):
+        #Print a progress line with rate and ETA, at most once per interval and at the end.
+        now = time.perf_counter()
+        if now - self._last_progress < self.interval and done < total:
+            return
+        self._last_progress = now
+        elapsed = now - self._progress_started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = f"{(total - done) / rate:.0f}s" if rate > 0 else "?"
+        print(f"  [profile] {done}/{total} {unit}, {rate:.2f} {unit}/s, elapsed {elapsed:.0f}s, ETA {eta}")
+
+    def report(self, script):
+        #Return the profile as a JSON-serialisable dict.
+        wall = time.perf_counter() - self.started
+        sections = {}
+        for name, (seconds, calls) in sorted(self.sections.items(), key=lambda item: -item[1][0]):
+            sections[name] = {
+                'seconds': seconds,
+                'calls': calls,
+                'mean_ms': 1000.0 * seconds / calls if calls else 0.0,
+            }
+        return {
+            'script': script,
+            'argv': sys.argv[1:],
+            'wall_seconds': wall,
+            'images': self.num_images,
+            'images_per_sec': self.num_images / wall if wall > 0 else None,
+            'image_seconds': self.image_seconds,
+            'memory_tracking': self.memory_mode,
+            'max_image_peak_memory_bytes': self.max_image_memory if self.memory_mode else None,
+            'sections': sections,
+            'slowest_images': [{'name': name, 'seconds': seconds, 'peak_memory_bytes': peak}
+                               for seconds, name, peak in sorted(self.images, reverse=True)],
+        }
+
+    def write_report(self, path, script):
+        #Write the JSON report and print the most expensive sections.
+        report = self.report(script)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f"Profile ({report['wall_seconds']:.1f}s wall, {report['images']} images) written to {path}")
+        for name, section in list(report['sections'].items())[:8]:
+            print(f"  {name:<24} {section['seconds']:9.3f}s {section['calls']:9d} calls")
+
+class ProfiledTask:
+    #Wraps a pool task so that it returns (result, statistics of the worker for this task).
+    #If name is given, name(item) is the image name the whole task is recorded under.
+    def __init__(self, func, name, track_memory, slowest):
+        self.func = func
+        self.name = name
+        self.track_memory = track_memory
+        self.slowest = slowest
+
+    def __call__(self, item):
+        profiler = _active
+        if profiler is None or profiler.pid != os.getpid():
+            #A fresh profiler in a worker, rather than a copy of the parent's inherited by fork.
+            profiler = enable(self.track_memory, self.slowest)
+        if self.name is None:
+            result = self.func(item)
+        else:
+            with profiler.image(self.name(item)):
+                result = self.func(item)
+        return result, profiler.take_stats()
+
+def enable(track_memory=True, slowest=10, interval=10.0):
+    #Start profiling in this process and return the profiler.
+    global _active
+    _active = Profiler(track_memory, slowest, interval)
+    return _active
+
+def active():
+    return _active
+
+def section(name):
+    #Time a hot section: with section('find_contours'): ...
+    if _active is None:
+        return _NULL_BLOCK
+    return _active.section(name)
+
+def image(name):
+    #Time one image and measure its peak memory: with image(file_name): ...
+    if _active is None:
+        return _NULL_BLOCK
+    return _active.image(name)
+
+def task(func, name=None):
+    #Wrap a pool task so its worker statistics are returned with every result. name must be
+    #picklable (e.g. str or operator.itemgetter(0)) and maps a task item to its image name.
+    if _active is None:
+        return func
+    return ProfiledTask(func, name, _active.track_memory, _active.slowest)
+
+def collect(results):
+    #Unwrap the results of a task() wrapped function, merging the worker statistics.
+    if _active is None:
+        for result in results:
+            yield result
+        return
+    for result, stats in results:
+        _active.merge(stats)
+        yield result
+
+def start_progress():
+    if _active is not None:
+        _active.start_progress()
+
+def progress(done, total, unit='images'):
+    if _active is not None:
+        _active.progress(done, total, unit)
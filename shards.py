@@ -0,0 +1,92 @@
+#This module packs patches and their annotations into fixed-size sequential tar shards.
+#All files of one sample (a patch, its masks and its labels) are stored next to each other,
+#so a training loader can stream the shards with large sequential reads. A JSON index records
+#the shard, data offset and size of every member, so a single file can also be read with one seek.
+
+import io
+import json
+import os
+import tarfile
+
+class ShardWriter:
+    def __init__(self, out_dir, prefix, max_shard_bytes=1 << 30):
+        #Shards are written as <out_dir>/<prefix>-00000.tar, ... and the index as <prefix>-index.json.
+        #A new shard is started once the current one reaches max_shard_bytes.
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.max_shard_bytes = max_shard_bytes
+        self.shards = []
+        self.members = {}
+        self._tar = None
+        os.makedirs(out_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _next_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+        name = f"{self.prefix}-{len(self.shards):05d}.tar"
+        self.shards.append(name)
+        self._tar = tarfile.open(os.path.join(self.out_dir, name), 'w')
+
+    def add_sample(self, members):
+        #Append one sample, a list of (file name, bytes) pairs. Samples never span two shards.
+        if self._tar is None or self._tar.offset >= self.max_shard_bytes:
+            self._next_shard()
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            #A fixed timestamp keeps shards byte-identical between runs.
+            info.mtime = 0
+            self._tar.addfile(info, io.BytesIO(data))
+            #The data ends the member, padded to a whole number of tar blocks.
+            padded_size = (info.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+            offset = self._tar.offset - padded_size
+            self.members[name] = [len(self.shards) - 1, offset, info.size]
+
+    def close(self):
+        #Close the last shard and write the offset index.
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+        index_path = os.path.join(self.out_dir, f"{self.prefix}-index.json")
+        with open(index_path, 'w') as f:
+            json.dump({'shards': self.shards, 'members': self.members}, f, separators=(',', ':'))
+
+class ShardReader:
+    def __init__(self, index_path):
+        #Random access to the members of the shards described by a <prefix>-index.json file.
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        self.shard_dir = os.path.dirname(os.path.abspath(index_path))
+        self.shards = index['shards']
+        self.members = index['members']
+        self._files = {}
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def names(self):
+        #Member names in the order they were written.
+        return list(self.members)
+
+    def read(self, name):
+        #Return the bytes of one member with a single seek and read.
+        shard, offset, size = self.members[name]
+        f = self._files.get(shard)
+        if f is None:
+            f = self._files[shard] = open(os.path.join(self.shard_dir, self.shards[shard]), 'rb')
+        f.seek(offset)
+        return f.read(size)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
@@ -8,7 +8,303 @@ import numpy as np
 from natsort import natsorted
 from glob import glob
 from shutil import copyfile
+from functools import partial
+from multiprocessing import Pool
 import argparse
+import json
+import random
+from manifest import Manifest, describe_files
+from image_header import read_image_size
+from parallel import imap_bounded
+from shards import ShardWriter
+from png_strips import StripReader
+from patch_encoder import PatchEncoder, FORMATS, output_ext, encode_params, merge_stats, new_stats, report_encoding
+import profiler
+
+EXTS = ['.png', '.jpg', '.jpeg', '.webp']
+
+def get_windows(h, w, patch_h, patch_w, overlap):
+    #Compute the (y0, y1, x0, x1) patch windows for an image of size h x w.
+    #Start coordinates are shifted back so every patch has the exact patch size,
+    #and windows repeated by that shift at the image border are only listed once.
+    ys, xs = [], []
+    for y0 in range(0, h, patch_h - overlap):
+        y1 = min(y0 + patch_h, h)
+        if not ys or ys[-1][1] != y1:
+            ys.append((y1 - patch_h, y1))
+    for x0 in range(0, w, patch_w - overlap):
+        x1 = min(x0 + patch_w, w)
+        if not xs or xs[-1][1] != x1:
+            xs.append((x1 - patch_w, x1))
+    return [(y0, y1, x0, x1) for y0, y1 in ys for x0, x1 in xs]
+
+def find_base_ids(src_dir):
+    #Find all base image names (without variant suffix) in the source directory.
+    base_ids = []
+    for ext in EXTS:
+        for fpath in glob(os.path.join(src_dir, f'*{ext}')):
+            name = os.path.splitext(os.path.basename(fpath))[0]
+            if '_' not in name:
+                base_ids.append(name)
+    return natsorted(list(set(base_ids)))
+
+def find_image(src_dir, name):
+    #Return the path of the first existing file for name with a supported extension.
+    for ext in EXTS:
+        candidate = os.path.join(src_dir, f"{name}{ext}")
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+def find_sources(src_dir, base, suffixes):
+    #Return the existing source files of all variants of a base image.
+    paths = [find_image(src_dir, f"{base}{suf}") for suf in suffixes]
+    return [p for p in paths if p is not None]
+
+def window_foreground(instance_img, windows):
+    #Count the instance pixels of every (y0, y1, x0, x1) window of a scene's _instance_id_RGB map.
+    #A pixel is foreground if its instance id r // 10 * 256 + g (see preprocess.decode_instance_map)
+    #is non-zero. The summed-area table is only sampled at the window borders: one pass over the
+    #scene sums the rows between consecutive border rows, after which every window is four lookups.
+    #instance_img is the decoded map, or a StripReader, which then only decodes one band at a time.
+    if isinstance(instance_img, StripReader):
+        read_rows = instance_img.rows
+    else:
+        read_rows = lambda a, b: instance_img[a:b]
+    win = np.array(windows, dtype=np.int64).reshape(-1, 4)
+    ys = np.unique(np.concatenate(([0], win[:, 0], win[:, 1])))
+    xs = np.unique(np.concatenate(([0], win[:, 2], win[:, 3])))
+
+    #sat[i, j] = number of foreground pixels in fg[:ys[i], :xs[j]].
+    bands = []
+    for a, b in zip(ys[:-1], ys[1:]):
+        band = read_rows(a, b)
+        fg = (band[:, :, 2] >= 10) | (band[:, :, 1] != 0)
+        bands.append(fg.sum(axis=0, dtype=np.int64))
+    rows = np.zeros((len(ys), len(bands[0]) + 1), dtype=np.int64)
+    rows[1:, 1:] = np.cumsum(np.cumsum(bands, axis=0), axis=1)
+    sat = rows[:, xs]
+
+    y0, y1 = np.searchsorted(ys, win[:, 0]), np.searchsorted(ys, win[:, 1])
+    x0, x1 = np.searchsorted(xs, win[:, 2]), np.searchsorted(xs, win[:, 3])
+    return (sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]).tolist()
+
+def keep_window(key, fg_pixels, opts):
+    #Decide whether a window is written. Windows with fewer than min_fg_pixels instance pixels
+    #are empty, and each is kept with probability keep_empty. The draw is seeded by the window
+    #name, so the decision does not depend on worker scheduling and is stable between runs.
+    if fg_pixels >= opts['min_fg_pixels']:
+        return True
+    return random.Random(f"{opts['filter_seed']}:{key}").random() < opts['keep_empty']
+
+def open_image(fpath, opts):
+    #Decode an image, or in streaming mode open it for strip decoding (see png_strips.py).
+    #Returns None if the image cannot be read.
+    with profiler.section('imread'):
+        if not opts['stream']:
+            return cv2.imread(fpath)
+        try:
+            return StripReader(fpath, strip_rows=opts['patch_h'])
+        except (OSError, ValueError):
+            return None
+
+def image_size(img):
+    #Return (h, w) of a decoded image or a StripReader.
+    if isinstance(img, StripReader):
+        return img.height, img.width
+    return img.shape[:2]
+
+def filter_windows(base, windows, opts):
+    #Return the keep decisions of the windows of a base image, as a list of
+    #(y0, y1, x0, x1, foreground pixels, kept) rows, or None if the scene has no instance
+    #mask. An untiled image is a single window. Also returns the decoded mask, so it is not
+    #read twice; in streaming mode the mask is decoded again band by band while tiling.
+    fpath = find_image(opts['src_dir'], f"{base}_instance_id_RGB")
+    instance_img = None
+    if fpath is not None:
+        instance_img = open_image(fpath, opts)
+    if instance_img is None:
+        print(f"  [WARN] no instance mask, keeping all windows: {base}")
+        return None, None
+    if not windows:
+        h, w = image_size(instance_img)
+        windows = [(0, h, 0, w)]
+    decisions = []
+    with profiler.section('window_filter'):
+        fg_counts = window_foreground(instance_img, windows)
+    for window, fg_pixels in zip(windows, fg_counts):
+        y0, y1, x0, x1 = window
+        kept = keep_window(f"{base}_{y0}_{y1}_{x0}_{x1}", fg_pixels, opts)
+        decisions.append([y0, y1, x0, x1, fg_pixels, kept])
+    if isinstance(instance_img, StripReader):
+        instance_img.close()
+        instance_img = None
+    return decisions, instance_img
+
+def write_filter_manifest(path, opts, decisions):
+    #Record the window filter parameters and every window's foreground count and decision.
+    manifest = {
+        'min_fg_pixels': opts['min_fg_pixels'],
+        'keep_empty': opts['keep_empty'],
+        'filter_seed': opts['filter_seed'],
+        'scenes': decisions,
+    }
+    with open(path, 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    windows = [d for scene in decisions.values() for d in scene]
+    kept = sum(1 for d in windows if d[5])
+    empty = sum(1 for d in windows if d[4] < opts['min_fg_pixels'])
+    print(f"  Kept {kept} of {len(windows)} windows ({empty} empty); decisions written to {path}")
+
+def process_base(base, opts):
+    #Split every variant (image and instance masks) of one base image into patches.
+    #Each source file is decoded exactly once. Returns (base, worker pid, outputs, input
+    #descriptions, window filter decisions, encoding statistics), the input descriptions only
+    #for incremental runs. Outputs are the written paths, or in tar mode the encoded samples:
+    #one list of (file name, bytes) per window.
+    src_dir, dst_dir = opts['src_dir'], opts['dst_dir']
+    patch_h, patch_w = opts['patch_h'], opts['patch_w']
+    outputs = []
+    samples = {} if opts['output_format'] == 'tar' else None
+    encoder = PatchEncoder(opts['encode_threads'])
+
+    def add_encoded(done):
+        #Record encoded patches, which the encoder returns in the order they were submitted.
+        for (key, name, out_path), data in done:
+            if samples is not None:
+                samples.setdefault(key, []).append((name, data))
+            else:
+                outputs.append(out_path)
+
+    #Describe the inputs before reading them, so a source changed mid-run is seen as stale later.
+    inputs = None
+    if opts['incremental']:
+        inputs = describe_files(find_sources(src_dir, base, opts['suffixes']))
+
+    #Decide which windows to keep from the instance mask before any patch is written.
+    decisions, instance_img = None, None
+    if opts['keep_empty'] < 1.0 and opts['split'] != 'test':
+        fpath = find_image(src_dir, base)
+        size = read_image_size(fpath) if fpath is not None else None
+        windows = []
+        if size is not None and size[0] > patch_h and size[1] > patch_w:
+            windows = get_windows(size[0], size[1], patch_h, patch_w, opts['overlap'])
+        decisions, instance_img = filter_windows(base, windows, opts)
+    dropped = set()
+    if decisions is not None:
+        dropped = {tuple(d[:4]) for d in decisions if not d[5]}
+
+    for suf in opts['suffixes']:
+        #Find the image file with current suffix.
+        fpath = find_image(src_dir, f"{base}{suf}")
+        if fpath is None:
+            if not (opts['split'] == 'test' and suf != ''):
+                print(f"  [WARN] missing file: {base}{suf} (searched exts: {EXTS})")
+            continue
+
+        #Read the image, reusing the instance mask decoded for the window filter. In streaming
+        #mode only the header is read here, and the rows of each band of windows are decoded
+        #when its first patch is cropped, so peak memory depends on the width of the scene.
+        if suf == '_instance_id_RGB' and instance_img is not None:
+            img = instance_img
+        else:
+            img = open_image(fpath, opts)
+        if img is None:
+            print(f"  [ERROR] could not read: {os.path.basename(fpath)}")
+            continue
+        h, w = image_size(img)
+        src_ext = os.path.splitext(fpath)[1]
+        out_ext = output_ext(src_ext, opts['image_format'] if suf == '' else opts['mask_format'])
+        params = encode_params(out_ext, opts['png_compression'])
+
+        #Split large images into patches with overlap.
+        if h > patch_h and w > patch_w:
+            for y0, y1, x0, x1 in get_windows(h, w, patch_h, patch_w, opts['overlap']):
+                if (y0, y1, x0, x1) in dropped:
+                    continue
+                #Extract and save the patch.
+                if isinstance(img, StripReader):
+                    with profiler.section('strip_decode'):
+                        patch = img.rows(y0, y1)[:, x0:x1]
+                else:
+                    patch = img[y0:y1, x0:x1]
+                key = f"{base}_{y0}_{y1}_{x0}_{x1}"
+                name = f"{key}{suf}{out_ext}"
+                out_path = os.path.join(dst_dir, name) if samples is None else None
+                add_encoded(encoder.submit((key, name, out_path), patch, out_ext, params, out_path))
+        elif (0, h, 0, w) in dropped:
+            #The whole small image is empty and was filtered out.
+            continue
+        elif out_ext != src_ext:
+            #Small images are not split, but still converted to the requested format.
+            name = f"{os.path.splitext(os.path.basename(fpath))[0]}{out_ext}"
+            out_path = os.path.join(dst_dir, name) if samples is None else None
+            full = img.rows(0, h) if isinstance(img, StripReader) else img
+            add_encoded(encoder.submit((base, name, out_path), full, out_ext, params, out_path))
+        elif samples is not None:
+            #Pack small images as they are without splitting.
+            with open(fpath, 'rb') as f:
+                samples.setdefault(base, []).append((os.path.basename(fpath), f.read()))
+        else:
+            #Copy small images as they are without splitting.
+            out_path = os.path.join(dst_dir, os.path.basename(fpath))
+            with profiler.section('copy'):
+                copyfile(fpath, out_path)
+            outputs.append(out_path)
+        #Finish the encodes of this file, so the outputs of each file stay together.
+        add_encoded(encoder.flush())
+        if isinstance(img, StripReader):
+            img.close()
+    encoder.close()
+
+    if samples is not None:
+        #Group the variants of each window, so they are stored next to each other.
+        outputs = list(samples.values())
+    return base, os.getpid(), outputs, inputs, decisions, encoder.stats
+
+def index_base(base, opts):
+    #Describe the windows of one base image for the virtual patch index, reading only the
+    #image header. Returns None if the image is missing or unreadable.
+    fpath = find_image(opts['src_dir'], base)
+    size = read_image_size(fpath) if fpath is not None else None
+    if size is None:
+        print(f"  [WARN] missing or unreadable file: {base}")
+        return None
+    h, w = size
+    patch_h, patch_w = opts['patch_h'], opts['patch_w']
+    tiled = h > patch_h and w > patch_w
+    windows = get_windows(h, w, patch_h, patch_w, opts['overlap']) if tiled else [(0, h, 0, w)]
+
+    #Source files are stored relative to the index, so the dataset can be moved as a whole.
+    files = {}
+    for suf in opts['suffixes']:
+        path = find_image(opts['src_dir'], f"{base}{suf}")
+        if path is not None:
+            files[suf] = os.path.relpath(path, opts['index_dir']).replace(os.sep, '/')
+    return {
+        'base': base,
+        'height': h,
+        'width': w,
+        'tiled': tiled,
+        'files': files,
+        'windows': [list(window) for window in windows],
+    }
+
+def write_window_index(base_ids, opts, index_path):
+    #Write the virtual patch index of a split: every scene with the windows its tiling produces.
+    scenes = [scene for scene in (index_base(base, opts) for base in base_ids) if scene is not None]
+    index = {
+        'patch_height': opts['patch_h'],
+        'patch_width': opts['patch_w'],
+        'overlap': opts['overlap'],
+        'suffixes': opts['suffixes'],
+        'scenes': scenes,
+    }
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with open(index_path, 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    num_windows = sum(len(scene['windows']) for scene in scenes)
+    print(f"  Wrote {num_windows} windows of {len(scenes)} scenes to {index_path}")
 
 def main(args):
     #Extract command line arguments for processing.
@@ -16,9 +312,13 @@ def main(args):
     tar_root = args.tar
     splits = args.set.split(',')
     subfolder = args.image_sub_folder
-    patch_h, patch_w = args.patch_height, args.patch_width
-    overlap = args.overlap_area
-    exts = ['.png', '.jpg', '.jpeg']
+    workers = max(1, getattr(args, 'workers', 1))
+    incremental = getattr(args, 'incremental', False)
+    output_format = getattr(args, 'output_format', 'files')
+    virtual = getattr(args, 'virtual', False)
+    profile_path = getattr(args, 'profile', None)
+    if profile_path:
+        profiler.enable()
 
     #Process each dataset split (train/val/test).
     for split in splits:
@@ -27,12 +327,13 @@ def main(args):
             continue
 
         print(f"\n>> Processing split: {split}")
-        
+
         #Set up source and destination directories
         src_dir = os.path.join(src_root, split, subfolder)
         dst_dir = os.path.join(tar_root, split, subfolder)
 
-        os.makedirs(dst_dir, exist_ok=True)
+        if output_format == 'files' and not virtual:
+            os.makedirs(dst_dir, exist_ok=True)
 
         #Define file suffixes for different image types.
         suffixes = ['']
@@ -40,65 +341,122 @@ def main(args):
             suffixes.extend(['_instance_color_RGB', '_instance_id_RGB'])
 
         #Find all base image names in the source directory.
-        base_ids = []
         if not os.path.exists(src_dir):
             print(f"  [ERROR] Source directory not found: {src_dir}")
             continue
-        else:
-            for ext in exts:
-                for fpath in glob(os.path.join(src_dir, f'*{ext}')):
-                    name = os.path.splitext(os.path.basename(fpath))[0]
-                    if '_' not in name:
-                        base_ids.append(name)
-        base_ids = natsorted(list(set(base_ids)))
-        
+        base_ids = find_base_ids(src_dir)
+
         print(f"Found {len(base_ids)} raw images in {src_dir}")
 
-        #Process each base image with all its variants.
-        for base in base_ids:
-            for suf in suffixes:
-                #Find the image file with current suffix.
-                fpath = None
-                for ext in exts:
-                    candidate = os.path.join(src_dir, f"{base}{suf}{ext}")
-                    if os.path.exists(candidate):
-                        fpath = candidate
-                        break
-
-                if fpath is None:
-                    if not (split == 'test' and suf != ''):
-                         print(f"  [WARN] missing file: {base}{suf} (searched exts: {exts})")
-                    continue
+        opts = {
+            'src_dir': src_dir,
+            'dst_dir': dst_dir,
+            'split': split,
+            'suffixes': suffixes,
+            'patch_h': args.patch_height,
+            'patch_w': args.patch_width,
+            'overlap': args.overlap_area,
+            'incremental': incremental,
+            'output_format': output_format,
+            'min_fg_pixels': getattr(args, 'min_fg_pixels', 1),
+            'keep_empty': getattr(args, 'keep_empty', 1.0),
+            'filter_seed': getattr(args, 'filter_seed', 0),
+            'stream': getattr(args, 'stream', False),
+            'image_format': getattr(args, 'image_format', 'same'),
+            'mask_format': getattr(args, 'mask_format', 'same'),
+            'png_compression': getattr(args, 'png_compression', None),
+            'encode_threads': getattr(args, 'encode_threads', 0),
+        }
+        task = profiler.task(partial(process_base, opts=opts), name=str)
 
-                #Read the image.
-                img = cv2.imread(fpath)
-                if img is None:
-                    print(f"  [ERROR] could not read: {os.path.basename(fpath)}")
-                    continue
-                h, w = img.shape[:2]
-
-                #Split large images into patches with overlap.
-                if h > patch_h and w > patch_w:
-                    for y0 in range(0, h, patch_h - overlap):
-                        for x0 in range(0, w, patch_w - overlap):
-                            y1 = min(y0 + patch_h, h)
-                            x1 = min(x0 + patch_w, w)
-                            
-                            #Ensure patch has exact dimensions by adjusting start coordinates.
-                            final_y0 = y1 - patch_h
-                            final_x0 = x1 - patch_w
-                            
-                            #Extract and save the patch.
-                            patch = img[final_y0:y1, final_x0:x1]
-                            
-                            out_ext = os.path.splitext(fpath)[1]
-                            out_name = f"{base}_{final_y0}_{y1}_{final_x0}_{x1}{suf}{out_ext}"
-                            out_path = os.path.join(dst_dir, out_name)
-                            cv2.imwrite(out_path, patch)
+        #In virtual mode, only write the window index; patches are served by patch_dataset.py.
+        if virtual:
+            opts['index_dir'] = os.path.join(tar_root, split)
+            write_window_index(base_ids, opts, os.path.join(tar_root, split, f'windows_{split}.json'))
+            continue
+
+        #In incremental mode, skip bases whose sources and parameters are unchanged.
+        manifest = None
+        if incremental:
+            params = {key: opts[key] for key in ('suffixes', 'patch_h', 'patch_w', 'overlap',
+                                                 'min_fg_pixels', 'keep_empty', 'filter_seed',
+                                                 'image_format', 'mask_format', 'png_compression')}
+            manifest = Manifest(os.path.join(tar_root, '.isaid_cache', f'split_{split}.jsonl'), params)
+            todo = [base for base in base_ids
+                    if not manifest.is_fresh(base, find_sources(src_dir, base, suffixes))]
+            print(f"  {len(base_ids) - len(todo)} raw images are up to date")
+            all_base_ids, base_ids = base_ids, todo
+
+        #Process each base image with all its variants, sharding bases across workers.
+        #Results come back in base order, so progress and output names stay deterministic.
+        #In tar mode, the patches are packed into sequential shards with an offset index.
+        shard_writer = None
+        if output_format == 'tar':
+            shard_writer = ShardWriter(os.path.join(tar_root, split), f'patches_{split}',
+                                       args.shard_size << 20)
+
+        #Window filter decisions of every base; in incremental mode, those of skipped bases
+        #are carried over from the previous run.
+        filter_path = os.path.join(tar_root, split, f'window_filter_{split}.json')
+        filtering = opts['keep_empty'] < 1.0 and split != 'test'
+        decisions = {}
+        if filtering and manifest is not None and os.path.exists(filter_path):
+            with open(filter_path, 'r') as f:
+                decisions = {base: d for base, d in json.load(f)['scenes'].items() if base in all_base_ids}
+
+        per_worker = {}
+        encode_stats = new_stats()
+        if workers > 1:
+            pool = Pool(processes=workers)
+            results = imap_bounded(pool, task, base_ids, workers * 2)
+        else:
+            pool = None
+            results = map(task, base_ids)
+        profiler.start_progress()
+        try:
+            for i, (base, pid, outputs, inputs, base_decisions, stats) in enumerate(profiler.collect(results), 1):
+                merge_stats(encode_stats, stats)
+                if base_decisions is not None:
+                    decisions[base] = base_decisions
+                if shard_writer is not None:
+                    with profiler.section('shard_write'):
+                        for sample in outputs:
+                            shard_writer.add_sample(sample)
+                    written = sum(len(sample) for sample in outputs)
                 else:
-                    #Copy small images as they are without splitting.
-                    out_name = os.path.basename(fpath)
-                    copyfile(fpath, os.path.join(dst_dir, out_name))
+                    written = len(outputs)
+                per_worker[pid] = per_worker.get(pid, 0) + written
+                if manifest is not None:
+                    manifest.record(base, inputs, outputs)
+                print(f"  [{i}/{len(base_ids)}] {base}: {written} files (worker {pid})")
+                profiler.progress(i, len(base_ids), 'scenes')
+            if manifest is not None:
+                #Remove the patches of raw images that no longer exist.
+                manifest.prune(all_base_ids)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if manifest is not None:
+                manifest.close()
+            if shard_writer is not None:
+                shard_writer.close()
+
+        if filtering:
+            write_filter_manifest(filter_path, opts, decisions)
+
+        #Report the size/speed tradeoff of the encoding settings.
+        encoding = f"images {opts['image_format']}, masks {opts['mask_format']}"
+        if opts['png_compression'] is not None:
+            encoding += f", PNG compression {opts['png_compression']}"
+        report_encoding(encode_stats, encoding, opts['encode_threads'])
+
+        if workers > 1:
+            for pid, written in sorted(per_worker.items()):
+                print(f"  worker {pid}: {written} files")
+
+    if profile_path:
+        profiler.active().write_report(profile_path, 'split')
 
 if __name__ == '__main__':
     #Parse command line arguments for image splitting parameters.
@@ -110,5 +468,39 @@ if __name__ == '__main__':
     parser.add_argument('--patch_width', default=800, type=int)
     parser.add_argument('--patch_height', default=800, type=int)
     parser.add_argument('--overlap_area', default=200, type=int)
+    parser.add_argument('--workers', default=1, type=int,
+                        help="Number of worker processes; base images are sharded across them.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Skip base images whose sources and parameters are unchanged since the last run.")
+    parser.add_argument('--virtual', action='store_true',
+                        help="Write a window index (windows_<split>.json) instead of patch files.")
+    parser.add_argument('--output_format', default='files', choices=['files', 'tar'],
+                        help="Write one file per patch, or pack the patches into tar shards with an offset index.")
+    parser.add_argument('--shard_size', default=1024, type=int,
+                        help="Target size of each tar shard in MB.")
+    parser.add_argument('--min_fg_pixels', default=1, type=int,
+                        help="Windows with fewer instance pixels than this are considered empty.")
+    parser.add_argument('--keep_empty', default=1.0, type=float,
+                        help="Fraction of empty windows to keep (0 drops them all, 1 disables filtering).")
+    parser.add_argument('--filter_seed', default=0, type=int,
+                        help="Seed of the per-window draw that selects the kept empty windows.")
+    parser.add_argument('--stream', action='store_true',
+                        help="Decode PNG sources in strips of about patch_height rows and write each band "
+                             "of patches as it is decoded, so peak memory depends on the scene width only.")
+    parser.add_argument('--image_format', default='same', choices=FORMATS,
+                        help="Format of the RGB patches: that of the source image, PNG or lossless WebP.")
+    parser.add_argument('--mask_format', default='same', choices=FORMATS,
+                        help="Format of the instance mask patches: that of the source mask, PNG or lossless WebP.")
+    parser.add_argument('--png_compression', default=None, type=int, choices=range(10), metavar='0-9',
+                        help="zlib level of PNG patches (default: OpenCV's default). Lower is faster and larger.")
+    parser.add_argument('--encode_threads', default=0, type=int,
+                        help="Threads that encode patches while the next ones are cropped (0: encode inline).")
+    parser.add_argument('--profile', nargs='?', const='profile_split.json', default=None,
+                        help="Record time and call counts of the hot sections, per-scene time and peak "
+                             "memory, and write a JSON report (default: profile_split.json).")
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    if args.incremental and args.output_format == 'tar':
+        parser.error("--incremental is only supported with --output_format files")
+    if args.virtual and args.keep_empty < 1.0:
+        parser.error("--keep_empty is not supported with --virtual")
+    main(args)
@@ -0,0 +1,241 @@
+#This program fuses the splitting and annotation steps for the iSAID dataset.
+#Each scene and its instance ID mask are decoded once, the mask is cropped in memory for every
+#patch window, and only the RGB patches are written, together with the COCO-style JSON file.
+#The output matches running split.py followed by preprocess.py, without the intermediate mask patches.
+
+import argparse
+import json
+import os
+import cv2
+from functools import partial
+from multiprocessing import Pool
+from shutil import copyfile
+from natsort import natsorted
+from split import get_windows, find_base_ids, find_image
+from preprocess import (get_category_info, decode_instance_map, extract_instances,
+                        extract_window_instances, report_simplification, CocoJsonWriter)
+from parallel import imap_bounded
+from shards import ShardWriter
+from annotation_store import AnnotationStoreWriter
+
+def parse_args():
+    #Parse command line arguments for the fused splitting and annotation parameters.
+    parser = argparse.ArgumentParser(description='Split the iSAID images and generate COCO-style JSON in one pass')
+    parser.add_argument('--src', default='./iSAID_dataset', type=str)
+    parser.add_argument('--tar', default='./iSAID_patches', type=str)
+    parser.add_argument('--image_sub_folder', default='images', type=str)
+    parser.add_argument('--set', default="train,val", type=str)
+    parser.add_argument('--patch_width', default=800, type=int)
+    parser.add_argument('--patch_height', default=800, type=int)
+    parser.add_argument('--overlap_area', default=200, type=int)
+    parser.add_argument('--workers', default=1, type=int,
+                        help="Number of worker processes; base images are sharded across them.")
+    parser.add_argument('--mode', default='patch', choices=['patch', 'scene'],
+                        help="'patch' annotates every window crop on its own; 'scene' labels the whole "
+                             "scene once and clips each instance to the windows it overlaps.")
+    parser.add_argument('--compact', action='store_true',
+                        help="Write the JSON without indentation or whitespace.")
+    parser.add_argument('--precision', default=None, type=int,
+                        help="Round polygon coordinates to this many decimals.")
+    parser.add_argument('--output_format', default='files', choices=['files', 'tar'],
+                        help="Write one file per patch, or pack every patch with its COCO annotations "
+                             "(<patch>.json) into tar shards with an offset index.")
+    parser.add_argument('--shard_size', default=1024, type=int,
+                        help="Target size of each tar shard in MB.")
+    parser.add_argument('--binary_store', action='store_true',
+                        help="Also write the annotations to a memory-mappable binary store "
+                             "(instancesonly_filtered_<split>.store) next to the JSON file.")
+    parser.add_argument('--seg_format', default='polygon', choices=['polygon', 'rle'],
+                        help="Write segmentations as polygons or as compressed COCO RLE.")
+    parser.add_argument('--simplify_tolerance', default=0.0, type=float,
+                        help="Simplify polygons with Douglas-Peucker at this tolerance in pixels (0 disables).")
+    parser.add_argument('--min_iou', default=0.9, type=float,
+                        help="Keep the original polygons of an instance if the simplified ones have a "
+                             "lower mask IoU than this.")
+    args = parser.parse_args()
+    if args.binary_store and args.seg_format == 'rle':
+        parser.error("--binary_store only supports --seg_format polygon")
+    return args
+
+def process_base(base, opts):
+    #Write the RGB patches of one scene and annotate every window from the in-memory instance map.
+    #Returns (base, worker pid, patches, records): patches lists (file name, encoded bytes) in
+    #natsorted file order, with bytes only in tar mode, and records maps annotated file names
+    #to (width, height, instances).
+    src_dir, dst_dir = opts['src_dir'], opts['dst_dir']
+    patch_h, patch_w = opts['patch_h'], opts['patch_w']
+    pack = opts['output_format'] == 'tar'
+    patches = []
+    records = {}
+
+    #Read the scene image.
+    fpath = find_image(src_dir, base)
+    if fpath is None:
+        print(f"  [WARN] missing file: {base}")
+        return base, os.getpid(), patches, records
+    img = cv2.imread(fpath)
+    if img is None:
+        print(f"  [ERROR] could not read: {os.path.basename(fpath)}")
+        return base, os.getpid(), patches, records
+    h, w = img.shape[:2]
+
+    #Decode the instance ID mask of the scene once.
+    instance_map = None
+    if opts['annotate']:
+        ins_path = find_image(src_dir, f"{base}_instance_id_RGB")
+        instance_img = cv2.imread(ins_path) if ins_path is not None else None
+        if ins_path is None:
+            print(f"  [WARN] missing file: {base}_instance_id_RGB")
+        elif instance_img is None:
+            print(f"  [ERROR] could not read: {os.path.basename(ins_path)}")
+        elif instance_img.shape[:2] != (h, w):
+            print(f"  [WARN] instance mask size does not match image: {base}")
+        else:
+            instance_map = decode_instance_map(instance_img)
+            del instance_img
+
+    if h > patch_h and w > patch_w:
+        #Write the patches and annotate the matching crop of the instance map.
+        out_ext = os.path.splitext(fpath)[1]
+        windows = get_windows(h, w, patch_h, patch_w, opts['overlap'])
+        window_instances = None
+        if instance_map is not None and opts['mode'] == 'scene':
+            window_instances = extract_window_instances(instance_map, windows, opts['num_categories'],
+                                                        opts['seg_opts'])
+        for i, (y0, y1, x0, x1) in enumerate(windows):
+            out_name = f"{base}_{y0}_{y1}_{x0}_{x1}{out_ext}"
+            if pack:
+                ok, buf = cv2.imencode(out_ext, img[y0:y1, x0:x1])
+                patches.append((out_name, buf.tobytes()))
+            else:
+                cv2.imwrite(os.path.join(dst_dir, out_name), img[y0:y1, x0:x1])
+                patches.append((out_name, None))
+            if window_instances is not None:
+                records[out_name] = (x1 - x0, y1 - y0, window_instances[i])
+            elif instance_map is not None:
+                instances = extract_instances(instance_map[y0:y1, x0:x1], opts['num_categories'],
+                                              opts['seg_opts'])
+                records[out_name] = (x1 - x0, y1 - y0, instances)
+    else:
+        #Copy small images as they are without splitting.
+        out_name = os.path.basename(fpath)
+        if pack:
+            with open(fpath, 'rb') as f:
+                patches.append((out_name, f.read()))
+        else:
+            copyfile(fpath, os.path.join(dst_dir, out_name))
+            patches.append((out_name, None))
+        if instance_map is not None:
+            records[out_name] = (w, h, extract_instances(instance_map, opts['num_categories'], opts['seg_opts']))
+
+    return base, os.getpid(), natsorted(patches, key=lambda p: p[0]), records
+
+def main(args):
+    categories = get_category_info()
+    workers = max(1, args.workers)
+
+    #Process each dataset split (train/val/test).
+    for split in args.set.split(','):
+        if split not in ('train', 'val', 'test'):
+            print(f"Skipping invalid split: {split}")
+            continue
+
+        print(f"\n>> Processing split: {split}")
+        src_dir = os.path.join(args.src, split, args.image_sub_folder)
+        dst_dir = os.path.join(args.tar, split, args.image_sub_folder)
+        if not os.path.exists(src_dir):
+            print(f"  [ERROR] Source directory not found: {src_dir}")
+            continue
+        os.makedirs(dst_dir if args.output_format == 'files' else os.path.join(args.tar, split), exist_ok=True)
+
+        base_ids = find_base_ids(src_dir)
+        print(f"Found {len(base_ids)} raw images in {src_dir}")
+
+        #The test split has no instance masks, so its patches are only tiled.
+        annotate = split != 'test'
+        opts = {
+            'src_dir': src_dir,
+            'dst_dir': dst_dir,
+            'annotate': annotate,
+            'mode': args.mode,
+            'output_format': args.output_format,
+            'num_categories': len(categories),
+            'patch_h': args.patch_height,
+            'patch_w': args.patch_width,
+            'overlap': args.overlap_area,
+            'seg_opts': {
+                'seg_format': args.seg_format,
+                'simplify_tolerance': args.simplify_tolerance,
+                'min_iou': args.min_iou,
+            },
+        }
+        task = partial(process_base, opts=opts)
+
+        writer = None
+        if annotate:
+            out_json_path = os.path.join(args.tar, split, f'instancesonly_filtered_{split}.json')
+            writer = CocoJsonWriter(out_json_path, categories,
+                                    indent=None if args.compact else 4,
+                                    precision=args.precision)
+        store = None
+        if annotate and args.binary_store:
+            store = AnnotationStoreWriter(os.path.splitext(out_json_path)[0] + '.store', categories)
+
+        #In tar mode, every patch is packed together with its COCO annotations.
+        shard_writer = None
+        if args.output_format == 'tar':
+            shard_writer = ShardWriter(os.path.join(args.tar, split), f'patches_{split}',
+                                       args.shard_size << 20)
+
+        simplify_stats = [0, 0, 0]
+
+        #Results come back in base order, so ids match split.py followed by preprocess.py.
+        if workers > 1:
+            pool = Pool(processes=workers)
+            results = imap_bounded(pool, task, base_ids, workers * 2)
+        else:
+            pool = None
+            results = map(task, base_ids)
+        try:
+            for i, (base, pid, patches, records) in enumerate(results, 1):
+                for _, _, instances in records.values():
+                    for instance in instances:
+                        for k, v in enumerate(instance.get('simplify_stats', ())):
+                            simplify_stats[k] += v
+                for out_name, data in patches:
+                    members = [(out_name, data)]
+                    if out_name in records:
+                        image, annotations = writer.add_patch(out_name, *records[out_name])
+                        if store is not None:
+                            store.add_patch(image, annotations)
+                        coco = {'image': image, 'annotations': annotations}
+                        members.append((os.path.splitext(out_name)[0] + '.json',
+                                        json.dumps(coco, separators=(',', ':')).encode('utf-8')))
+                    if shard_writer is not None:
+                        shard_writer.add_sample(members)
+                print(f"  [{i}/{len(base_ids)}] {base}: {len(patches)} files, {len(records)} annotated (worker {pid})")
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            if store is not None:
+                store.abort()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if shard_writer is not None:
+                shard_writer.close()
+
+        if writer is not None:
+            writer.close()
+            print(f"Wrote {writer.num_images} images and {writer.num_annotations} annotations to {out_json_path}")
+            if args.seg_format == 'polygon' and args.simplify_tolerance > 0:
+                report_simplification(simplify_stats, args.min_iou)
+        if store is not None:
+            store.close()
+            print(f"Wrote {store.num_polygons} polygons ({store.num_coords // 2} vertices) to {store.path}")
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)